@@ -1,16 +1,29 @@
 import os
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, request, abort
 from flask_cors import CORS
 from config import Config
-from models import db, Actor, Movie
-from auth import AuthError, requires_auth
+from models import db, Actor, Movie, TooManyRows
+from auth import AuthError, jwks_store, requires_auth, token_cache
+from cache import cached, response_cache
+from compression import compress_response
+from idempotency import idempotent
+from pooling import pool_stats
+from queries import (
+    attach_related, compile_filters, count_arg, count_rows, field_args,
+    filter_args, fold_stats_after_write, id_in, ids_arg, include_arg,
+    keyset_page, page_args, rows_by_ids, rows_to_dicts, select_columns,
+    stats_live, stats_summary)
+from responses import conditional, json_response, stream_json, stream_ndjson
 
 # create and configure the app
 app = Flask(__name__)
 app.config.from_object(Config)  # connect app to a local postgresql database
-db = SQLAlchemy(app)  # initializing the instance with the app context
+# the models' db serves every query, its session is removed after each
+# request
+db.init_app(app)
 CORS(app)
+app.after_request(compress_response)  # negotiated gzip / brotli
+app.after_request(fold_stats_after_write)  # stats deltas into counters
 
 # ROUTES
 
@@ -19,59 +32,283 @@ CORS(app)
 
 @app.route('/')
 def index():
-    return jsonify({
+    return json_response({
         'app status': 'healthy'
-    }), 200
+    }, 200)
 
 # Endpoint route handler for GET request for actor
 
 
+def get_many(key, model):
+    """
+    Get the rows of the comma separated `ids` argument in one query
+    :return details of the rows in request order and the missing ids
+    """
+    try:
+        ids = ids_arg(request.args, app.config['MAX_IDS'])
+        fields = field_args(request.args, model)
+        include = include_arg(request.args, model)
+    except ValueError:
+        abort(400)
+    try:
+        rows, missing = rows_by_ids(model, fields, ids)
+        if include:
+            attach_related(model, include,
+                           [row_id for row_id in ids if row_id not in missing],
+                           rows)
+    except Exception:
+        abort(422)
+    return json_response({
+        'success': True,
+        key: rows,
+        'missing': missing
+    }, 200)
+
+
 @app.route('/actors')
 @requires_auth('get:actor')
+@cached('actors', related=('movies',))
+@conditional(Actor)
 def get_actors(payload):
     """
-    Get details of all actors
-    :return details of all actors
+    Get a page of actors ordered by id, optionally filtered, or the actors
+    of `ids`
+    :return details of actors and the cursor of the next page
     """
+    if 'ids' in request.args:
+        return get_many('actors', Actor)
     try:
-        results = Actor.query.order_by(Actor.id).all()
-        if len(results) == 0:
-            abort(404)
-        actors = [row.format() for row in results]
-        return jsonify({
-            'success': True,
-            'actors': actors
-        }), 200
+        limit, after = page_args(
+            request.args, app.config['PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+        fields = field_args(request.args, Actor)
+        include = include_arg(request.args, Actor)
+        condition = compile_filters(Actor, filter_args(request.args))
+        count_mode = count_arg(request.args, app.config['COUNT_DEFAULT'])
+    except ValueError:
+        abort(400)
+    query = select_columns(Actor, fields)
+    if condition is not None:
+        query = query.filter(condition)
+    try:
+        results, next_cursor = keyset_page(query, Actor.id, limit, after)
+        actors = rows_to_dicts(results, fields)
+        if include:
+            attach_related(Actor, include, [row.id for row in results],
+                           actors)
+        total = count_rows(Actor, condition, count_mode,
+                           app.config['COUNT_CACHE_TTL'])
     except Exception:
         abort(422)
+    if len(results) == 0 and after is None and condition is None:
+        abort(404)
+    response = {
+        'success': True,
+        'actors': actors,
+        'next_cursor': next_cursor
+    }
+    if total is not None:
+        response.update({'total': total, 'total_mode': count_mode})
+    return json_response(response, 200)
 
 # Endpoint route handler for GET request for movies
 
 
 @app.route('/movies')
 @requires_auth('get:movies')
+@cached('movies', related=('actors',))
+@conditional(Movie)
 def get_movies(payload):
     """
-    Get details of all movies
+    Get a page of movies ordered by id, optionally filtered, or the movies
+    of `ids`
+    :return details of movies and the cursor of the next page
+    """
+    if 'ids' in request.args:
+        return get_many('movies', Movie)
+    try:
+        limit, after = page_args(
+            request.args, app.config['PAGE_SIZE'], app.config['MAX_PAGE_SIZE'])
+        fields = field_args(request.args, Movie)
+        include = include_arg(request.args, Movie)
+        condition = compile_filters(Movie, filter_args(request.args))
+        count_mode = count_arg(request.args, app.config['COUNT_DEFAULT'])
+    except ValueError:
+        abort(400)
+    query = select_columns(Movie, fields)
+    if condition is not None:
+        query = query.filter(condition)
+    try:
+        results, next_cursor = keyset_page(query, Movie.id, limit, after)
+        movies = rows_to_dicts(results, fields)
+        if include:
+            attach_related(Movie, include, [row.id for row in results],
+                           movies)
+        total = count_rows(Movie, condition, count_mode,
+                           app.config['COUNT_CACHE_TTL'])
+    except Exception:
+        abort(422)
+    if len(results) == 0 and after is None and condition is None:
+        abort(404)
+    response = {
+        'success': True,
+        'movies': movies,
+        'next_cursor': next_cursor
+    }
+    if total is not None:
+        response.update({'total': total, 'total_mode': count_mode})
+    return json_response(response, 200)
+
+# Endpoint route handlers for GET request for one actor or movie
+
+
+def get_row(model, row_id):
+    """
+    Select the requested fields of one row
+    :return dict of fields, aborts with 404 if the row does not exist
+    """
+    try:
+        fields = field_args(request.args, model)
+        include = include_arg(request.args, model)
+    except ValueError:
+        abort(400)
+    row = select_columns(model, fields).filter(
+        model.id == row_id).one_or_none()
+    if row is None:
+        abort(404)
+    item = dict(zip(fields, row))
+    if include:
+        attach_related(model, include, [row_id], [item])
+    return item
+
+
+@app.route('/actors/<int:actor_id>')
+@requires_auth('get:actor')
+@cached('actors', related=('movies',))
+@conditional(Actor)
+def get_actor(payload, actor_id):
+    """
+    Get details of given actor id
+    :return details of actor
+    """
+    return json_response({
+        'success': True,
+        'actor': get_row(Actor, actor_id)
+    }, 200)
+
+
+@app.route('/movies/<int:movie_id>')
+@requires_auth('get:movies')
+@cached('movies', related=('actors',))
+@conditional(Movie)
+def get_movie(payload, movie_id):
+    """
+    Get details of given movie id
+    :return details of movie
+    """
+    return json_response({
+        'success': True,
+        'movie': get_row(Movie, movie_id)
+    }, 200)
+
+# Endpoint route handlers for streaming exports of actors and movies
+
+
+def export_rows(key, model):
+    """
+    Streams every row of model matching the filter arguments as a JSON
+    document or NDJSON lines, depending on the `format` request argument
+    """
+    export_format = request.args.get('format', 'json')
+    if export_format not in ('json', 'ndjson'):
+        abort(400)
+    try:
+        fields = field_args(request.args, model)
+        condition = compile_filters(model, filter_args(request.args))
+    except ValueError:
+        abort(400)
+    batch_size = app.config['EXPORT_BATCH_SIZE']
+    query = select_columns(model, fields).order_by(model.id)
+    if condition is not None:
+        query = query.filter(condition)
+    # yield_per streams the rows through a server-side cursor
+    rows = (dict(zip(fields, row)) for row in query.yield_per(batch_size))
+    if export_format == 'ndjson':
+        return stream_ndjson(rows, batch_size)
+    return stream_json(key, rows, batch_size)
+
+
+@app.route('/actors/export')
+@requires_auth('get:actor')
+@conditional(Actor)
+def export_actors(payload):
+    """
+    Stream details of all actors
+    :return details of all actors
+    """
+    return export_rows('actors', Actor)
+
+
+@app.route('/movies/export')
+@requires_auth('get:movies')
+@conditional(Movie)
+def export_movies(payload):
+    """
+    Stream details of all movies
     :return details of all movies
     """
+    return export_rows('movies', Movie)
+
+# Endpoint route handler for GET request for statistics
+
+
+@app.route('/stats')
+@requires_auth(all_of=('get:actor', 'get:movies'))
+def get_stats(payload):
+    """
+    Get counts of actors by gender and age bucket and of movies by
+    release year, from the summary counters or, with `source=live`,
+    from GROUP BY queries over the tables
+    :return counts by dimension
+    """
+    source = request.args.get('source', app.config['STATS_SOURCE'])
+    if source not in ('summary', 'live'):
+        abort(400)
     try:
-        results = Movie.query.all()
-        if len(results) == 0:
-            abort(404)
-        movies = [row.format() for row in results]
-        return jsonify({
-            'success': True,
-            'movies': movies
-        }), 200
+        stats = stats_live() if source == 'live' else stats_summary()
     except Exception:
         abort(422)
+    stats.update({
+        'success': True,
+        'source': source
+    })
+    return json_response(stats, 200)
+
+# Endpoint route handler for GET request for metrics
+
+
+@app.route('/metrics')
+@requires_auth('get:metrics')
+def get_metrics(payload):
+    """
+    Get the counters of this worker process: database pool occupancy
+    and checkout waits, and hits of the token and response caches
+    :return metrics by component
+    """
+    return json_response({
+        'success': True,
+        'pool': pool_stats(db.engine.pool),
+        'jwks': jwks_store.stats(),
+        'token_cache': token_cache.stats(),
+        'response_cache':
+            response_cache.stats() if response_cache is not None else None
+    }, 200)
 
 # Endpoint route handler for POST request for actor
 
 
 @app.route('/actors', methods=['POST'])
 @requires_auth('post:actor')
+@idempotent
 def create_actor(payload):
     """
     Add new actor to database
@@ -89,10 +326,10 @@ def create_actor(payload):
         new_actor_formated = new_actor.format()
 
         # Return newly created actor
-        return jsonify({
+        return json_response({
             'success': True,
             'actor': new_actor_formated
-        }), 201
+        }, 201)
     except Exception:
         abort(422)
 
@@ -101,6 +338,7 @@ def create_actor(payload):
 
 @app.route('/movies', methods=['POST'])
 @requires_auth('post:Movies')
+@idempotent
 def create_movie(payload):
     """
     Add new movie to database
@@ -118,12 +356,254 @@ def create_movie(payload):
         new_movie_formated = new_movie.format()
 
         # Return newly created movie
-        return jsonify({
+        return json_response({
             'success': True,
             'movie': new_movie_formated
-        }), 201
+        }, 201)
+    except Exception:
+        abort(422)
+
+# Endpoint route handlers for bulk POST request for actors and movies
+
+
+def bulk_create(key, model):
+    """
+    Validate every item of the request body up front, then insert them
+    all in one transaction
+    :return ids of the new rows, or the errors of the invalid items
+    """
+    body = request.get_json(silent=True)
+    items = body.get(key) if isinstance(body, dict) else body
+    if not isinstance(items, list) or len(items) == 0:
+        abort(400)
+    if len(items) > app.config['BULK_MAX_ITEMS']:
+        abort(413)
+    rows = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            rows.append(model.validate(item))
+        except ValueError as error:
+            errors.append({'index': index, 'message': str(error)})
+    if errors:
+        return json_response({
+            'success': False,
+            'error': 422,
+            'message': 'unprocessable',
+            'errors': errors
+        }, 422)
+    try:
+        ids = model.bulk_insert(rows)
+    except Exception:
+        abort(422)
+    return json_response({
+        'success': True,
+        'created': ids
+    }, 201)
+
+
+@app.route('/actors/bulk', methods=['POST'])
+@requires_auth('post:actor')
+def create_actors(payload):
+    """
+    Add a list of new actors to database
+    :return ids of the newly added actors
+    """
+    return bulk_create('actors', Actor)
+
+
+@app.route('/movies/bulk', methods=['POST'])
+@requires_auth('post:Movies')
+def create_movies(payload):
+    """
+    Add a list of new movies to database
+    :return ids of the newly added movies
+    """
+    return bulk_create('movies', Movie)
+
+# Endpoint route handlers for bulk PATCH and DELETE request for actors
+# and movies
+
+
+def bulk_condition(model, body):
+    """
+    Compile the `ids` list and/or constrained `filter` of a bulk request
+    body into one SQL condition, aborts with 400 if neither is given
+    """
+    if not isinstance(body, dict):
+        abort(400)
+    ids = body.get('ids')
+    filters = body.get('filter') or {}
+    if ids is not None and (
+            not isinstance(ids, list) or len(ids) == 0 or
+            not all(type(row_id) is int for row_id in ids)):
+        abort(400)
+    if not isinstance(filters, dict):
+        abort(400)
+    try:
+        condition = compile_filters(model, filters)
+    except ValueError:
+        abort(400)
+    if ids is not None:
+        id_condition = id_in(model, ids)
+        condition = id_condition if condition is None else \
+            id_condition & condition
+    if condition is None:
+        abort(400)
+    return condition
+
+
+def too_many_rows(error):
+    """response for a bulk statement over the BULK_MAX_ROWS guard"""
+    return json_response({
+        'success': False,
+        'error': 422,
+        'message': 'matched more than the {} rows allowed'.format(
+            app.config['BULK_MAX_ROWS'])
+    }, 422)
+
+
+def bulk_update(model):
+    """
+    Update the rows matching the request body with its `values`
+    :return number of updated rows
+    """
+    body = request.get_json(silent=True)
+    condition = bulk_condition(model, body)
+    try:
+        values = model.validate(body.get('values'), partial=True)
+    except ValueError:
+        abort(400)
+    if not values:
+        abort(400)
+    try:
+        ids = model.bulk_update(
+            condition, values, app.config['BULK_MAX_ROWS'])
+    except TooManyRows as error:
+        return too_many_rows(error)
+    except Exception:
+        abort(422)
+    return json_response({
+        'success': True,
+        'updated': len(ids)
+    }, 200)
+
+
+def bulk_delete(model):
+    """
+    Delete the rows matching the request body
+    :return number of deleted rows
+    """
+    condition = bulk_condition(model, request.get_json(silent=True))
+    try:
+        ids = model.bulk_delete(condition, app.config['BULK_MAX_ROWS'])
+    except TooManyRows as error:
+        return too_many_rows(error)
+    except Exception:
+        abort(422)
+    return json_response({
+        'success': True,
+        'deleted': len(ids)
+    }, 200)
+
+
+@app.route('/actors', methods=['PATCH'])
+@requires_auth('patch:actor:bulk')
+def update_actors(payload):
+    """
+    Edit the actors matching an id list or filter
+    :return number of updated actors
+    """
+    return bulk_update(Actor)
+
+
+@app.route('/movies', methods=['PATCH'])
+@requires_auth('patch:movies:bulk')
+def update_movies(payload):
+    """
+    Edit the movies matching an id list or filter
+    :return number of updated movies
+    """
+    return bulk_update(Movie)
+
+
+@app.route('/actors', methods=['DELETE'])
+@requires_auth('delete:actor:bulk')
+def delete_actors(payload):
+    """
+    Delete the actors matching an id list or filter
+    :return number of deleted actors
+    """
+    return bulk_delete(Actor)
+
+
+@app.route('/movies', methods=['DELETE'])
+@requires_auth('delete:movies:bulk')
+def delete_movies(payload):
+    """
+    Delete the movies matching an id list or filter
+    :return number of deleted movies
+    """
+    return bulk_delete(Movie)
+
+# Endpoint route handlers for assigning actors to a movie
+
+
+def actor_ids_arg():
+    """
+    Read the `actor_ids` list of the request body, aborts with 400 if it
+    is missing or malformed
+    """
+    body = request.get_json(silent=True)
+    actor_ids = body.get('actor_ids') if isinstance(body, dict) else None
+    if not isinstance(actor_ids, list) or len(actor_ids) == 0 or \
+            not all(type(actor_id) is int for actor_id in actor_ids):
+        abort(400)
+    if len(actor_ids) > app.config['BULK_MAX_ITEMS']:
+        abort(413)
+    return actor_ids
+
+
+@app.route('/movies/<int:movie_id>/actors', methods=['POST'])
+@requires_auth('patch:Movies')
+def assign_actors(payload, movie_id):
+    """
+    Cast a list of actors in given movie id
+    :return number of actors newly cast
+    """
+    actor_ids = actor_ids_arg()
+    if db.session.query(Movie.id).filter(
+            Movie.id == movie_id).scalar() is None:
+        abort(404)
+    try:
+        assigned = Movie.assign_actors(movie_id, actor_ids)
+    except Exception:
+        abort(422)
+    return json_response({
+        'success': True,
+        'assigned': assigned
+    }, 200)
+
+
+@app.route('/movies/<int:movie_id>/actors', methods=['DELETE'])
+@requires_auth('patch:Movies')
+def unassign_actors(payload, movie_id):
+    """
+    Remove a list of actors from the cast of given movie id
+    :return number of actors removed
+    """
+    actor_ids = actor_ids_arg()
+    if db.session.query(Movie.id).filter(
+            Movie.id == movie_id).scalar() is None:
+        abort(404)
+    try:
+        unassigned = Movie.unassign_actors(movie_id, actor_ids)
     except Exception:
         abort(422)
+    return json_response({
+        'success': True,
+        'unassigned': unassigned
+    }, 200)
 
 # Endpoint route handler for PATCH request for actor
 
@@ -132,33 +612,27 @@ def create_movie(payload):
 @requires_auth('patch:actor')
 def update_actor(payload, actor_id):
     """
-    Edit information for given actor id
+    Edit the supplied fields of given actor id
     :return updated actor information
     """
-    actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-    if actor is None:
-        abort(404)
-
-    body = request.get_json(request)
-    name = body.get('name', None)
-    age = body.get('age', None)
-    gender = body.get('gender', None)
-    if name is None or age is None or gender is None:
+    try:
+        values = Actor.validate(request.get_json(silent=True), partial=True)
+    except ValueError:
+        abort(400)
+    if not values:
         abort(400)
     try:
-        actor.name = name
-        actor.age = age
-        actor.gender = gender
-        actor.update()
-        actor_formated = actor.format()
-
-        # Return edited actor
-        return jsonify({
-            'success': True,
-            'actor': actor_formated
-        }), 200
+        actor_formated = Actor.update_by_id(actor_id, values)
     except Exception:
         abort(422)
+    if actor_formated is None:
+        abort(404)
+
+    # Return edited actor
+    return json_response({
+        'success': True,
+        'actor': actor_formated
+    }, 200)
 
 # Endpoint route handler for PATCH request for movie
 
@@ -167,32 +641,27 @@ def update_actor(payload, actor_id):
 @requires_auth('patch:Movies')
 def update_movie(payload, movie_id):
     """
-    Edit information for given movie id
+    Edit the supplied fields of given movie id
     :return updated movie information
     """
-    movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-    if movie is None:
-        abort(404)
-
-    body = request.get_json(request)
-    title = body.get('title')
-    release_date = body.get('release_date')
-
-    if title is None or release_date is None:
+    try:
+        values = Movie.validate(request.get_json(silent=True), partial=True)
+    except ValueError:
+        abort(400)
+    if not values:
         abort(400)
     try:
-        movie.title = title
-        movie.release_date = release_date
-        movie.update()
-        movie_formated = movie.format()
-
-        # Return edited movie
-        return jsonify({
-            'success': True,
-            'movie': movie_formated
-        }), 200
+        movie_formated = Movie.update_by_id(movie_id, values)
     except Exception:
         abort(422)
+    if movie_formated is None:
+        abort(404)
+
+    # Return edited movie
+    return json_response({
+        'success': True,
+        'movie': movie_formated
+    }, 200)
 
 # Endpoint route handler for DELETE request for actor
 
@@ -204,18 +673,18 @@ def delete_actor(payload, actor_id):
     Delete actor using actor id
     :return id of actor being deleted
     """
-    actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-    if actor is None:
-        abort(404)
     try:
-        actor.delete()
-    # Return deleted actor id
-        return jsonify({
-            'success': True,
-            'delete': actor_id
-        }), 200
+        deleted = Actor.delete_by_id(actor_id)
     except Exception:
         abort(422)
+    if not deleted:
+        abort(404)
+
+    # Return deleted actor id
+    return json_response({
+        'success': True,
+        'delete': actor_id
+    }, 200)
 
 # Endpoint route handler for DELETE request for movie
 
@@ -227,18 +696,18 @@ def delete_movie(payload, movie_id):
     Delete movie using movie id
     :return id of movie being deleted
     """
-    movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-    if movie is None:
-        abort(404)
     try:
-        movie.delete()
-    # Return deleted movie id
-        return jsonify({
-            'success': True,
-            'delete': movie_id
-        }), 200
+        deleted = Movie.delete_by_id(movie_id)
     except Exception:
         abort(422)
+    if not deleted:
+        abort(404)
+
+    # Return deleted movie id
+    return json_response({
+        'success': True,
+        'delete': movie_id
+    }, 200)
 
 # Error handling
 
@@ -248,11 +717,11 @@ def unprocessable(error):
     """
     Unprocessable Entity
     """
-    return jsonify({
+    return json_response({
         "success": False,
         "error": 422,
         "message": "unprocessable"
-    }), 422
+    }, 422)
 
 
 @app.errorhandler(404)
@@ -260,11 +729,35 @@ def not_found(error):
     """
     Not Found
     """
-    return jsonify({
+    return json_response({
         "success": False,
         "error": 404,
         "message": "not found"
-    }), 404
+    }, 404)
+
+
+@app.errorhandler(409)
+def conflict(error):
+    """
+    Conflict
+    """
+    return json_response({
+        "success": False,
+        "error": 409,
+        "message": "conflict"
+    }, 409)
+
+
+@app.errorhandler(413)
+def too_large(error):
+    """
+    Request entity too large
+    """
+    return json_response({
+        "success": False,
+        "error": 413,
+        "message": "too many items"
+    }, 413)
 
 
 @app.errorhandler(400)
@@ -272,11 +765,11 @@ def bad_request(error):
     """
     Bad request
     """
-    return jsonify({
+    return json_response({
         "success": False,
         "error": 400,
         "message": "bad request"
-    }), 400
+    }, 400)
 
 # AuthError exceptions raised by the
 # @requires_auth(permission) decorator method
@@ -284,8 +777,8 @@ def bad_request(error):
 
 @app.errorhandler(AuthError)
 def auth_error(auth_error):
-    return jsonify({
+    return json_response({
         "success": False,
         "error": auth_error.status_code,
         "message": auth_error.error['description']
-    }), auth_error.status_code
+    }, auth_error.status_code)
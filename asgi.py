@@ -0,0 +1,290 @@
+"""
+ASGI entry point serving the same api as app.py, e.g.
+  `uvicorn asgi:app` (one process)
+  `gunicorn -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker asgi:app`
+With several workers RESPONSE_CACHE_URL must be a redis:// url or empty,
+the requests passed to Flask would otherwise be cached per process.
+
+The list and item GETs of actors and movies, the bulk of the read
+traffic, run as coroutines on an asyncio engine (asyncpg), so a slow
+query or JWKS fetch does not hold a worker and one process serves
+hundreds of requests at once. Every other request, and list requests
+using `ids`, `include` or `count`, is passed to the Flask app of app.py
+running in a thread pool, with the same auth decorator, error responses
+and behavior.
+"""
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response
+from starlette.routing import Match, Route
+from werkzeug.http import http_date, parse_date, parse_etags, quote_etag
+from app import app as flask_app
+from auth import AuthError, requires_auth
+from compression import compress_bytes, negotiate_encoding
+from config import Config, engine_options
+from models import Actor, Movie
+from queries import (
+    column_list, compile_filters, field_args, filter_args, page_args,
+    page_rows, rows_to_dicts, seek, table_version_columns)
+from responses import dumps, make_etag, not_modified
+
+# query parameters of the list routes that are left to the Flask app
+DELEGATED_ARGS = ('ids', 'include', 'count')
+
+# the messages of the Flask error handlers
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'not found',
+    409: 'conflict',
+    413: 'too many items',
+    422: 'unprocessable',
+}
+
+
+# Database
+def async_url(url):
+    """returns the url of url's database for its asyncio driver"""
+    for prefix, driver in (('postgres://', 'postgresql+asyncpg://'),
+                           ('postgresql://', 'postgresql+asyncpg://'),
+                           ('sqlite://', 'sqlite+aiosqlite://')):
+        if url.startswith(prefix):
+            return driver + url[len(prefix):]
+    return url
+
+
+class Database(object):
+    """asyncio engine and sessions, created on first use"""
+
+    def __init__(self):
+        self.engine = None
+        self._sessions = None
+
+    def session(self):
+        """
+        Example
+          `async with database.session() as session:`
+        """
+        if self._sessions is None:
+            url = async_url(flask_app.config['SQLALCHEMY_DATABASE_URI'])
+            self.engine = create_async_engine(
+                url, **engine_options(url, asyncio=True))
+            self._sessions = sessionmaker(
+                self.engine, class_=AsyncSession, expire_on_commit=False)
+        return self._sessions()
+
+    async def dispose(self):
+        if self.engine is not None:
+            await self.engine.dispose()
+
+
+database = Database()
+
+
+# Responses
+def json_body_response(request, obj, status=200, etag=None,
+                       last_modified=None):
+    """
+    JSON response compressed like the Flask app's, with the validators
+    of a conditional GET
+    """
+    body = dumps(obj) if obj is not None else b''
+    headers = {'Vary': 'Accept-Encoding'}
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding', ''))
+    weak = False
+    if encoding is not None and len(body) >= Config.COMPRESS_MIN_SIZE:
+        body = compress_bytes(body, encoding)
+        headers['Content-Encoding'] = encoding
+        weak = True
+    if etag is not None:
+        headers['ETag'] = ('W/' if weak else '') + quote_etag(etag)
+        headers['Cache-Control'] = 'private, no-cache'
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+    if status == 304:
+        return Response(status_code=304, headers=headers)
+    return Response(body, status_code=status, headers=headers,
+                    media_type='application/json')
+
+
+def full_path(request):
+    """returns the path and query of request like Flask's full_path"""
+    return '{}?{}'.format(request.scope['path'],
+                          request.scope['query_string'].decode('latin-1'))
+
+
+def revalidated(request, etag, last_modified):
+    """True if the client's ETag or Last-Modified is still current"""
+    return not_modified(
+        etag, last_modified,
+        parse_etags(request.headers.get('If-None-Match')),
+        parse_date(request.headers.get('If-Modified-Since')))
+
+
+# Routes
+async def list_rows(request, key, model):
+    """
+    Get a page of rows ordered by id, optionally filtered, with a 304
+    when the table did not change since the client's ETag
+    :return details of rows and the cursor of the next page
+    """
+    args = request.query_params
+    try:
+        limit, after = page_args(args, flask_app.config['PAGE_SIZE'],
+                                 flask_app.config['MAX_PAGE_SIZE'])
+        fields = field_args(args, model)
+        condition = compile_filters(model, filter_args(args))
+    except ValueError:
+        raise HTTPException(400)
+    try:
+        async with database.session() as session:
+            version = tuple((await session.execute(select(
+                *table_version_columns(
+                    model, session.bind.dialect.name)))).one())
+            etag = make_etag(version, full_path(request))
+            # no Last-Modified, a delete does not move any date
+            if revalidated(request, etag, None):
+                return json_body_response(request, None, 304, etag)
+            statement = select(*column_list(model, fields))
+            if condition is not None:
+                statement = statement.filter(condition)
+            rows = (await session.execute(
+                seek(statement, model.id, limit, after))).all()
+    except HTTPException:
+        raise
+    except Exception:
+        raise HTTPException(422)
+    results, next_cursor = page_rows(rows, limit)
+    if len(results) == 0 and after is None and condition is None:
+        raise HTTPException(404)
+    return json_body_response(request, {
+        'success': True,
+        key: rows_to_dicts(results, fields),
+        'next_cursor': next_cursor
+    }, 200, etag)
+
+
+async def get_row(request, key, model, row_id):
+    """
+    Get the requested fields of one row, with a 304 when the row did not
+    change since the client's ETag
+    :return details of the row
+    """
+    try:
+        fields = field_args(request.query_params, model)
+    except ValueError:
+        raise HTTPException(400)
+    async with database.session() as session:
+        updated_at = (await session.execute(
+            select(model.updated_at).filter(model.id == row_id))).scalar()
+        if updated_at is None:
+            raise HTTPException(404)
+        etag = make_etag((row_id, updated_at), full_path(request))
+        if revalidated(request, etag, updated_at):
+            return json_body_response(request, None, 304, etag, updated_at)
+        row = (await session.execute(
+            select(*column_list(model, fields)).filter(
+                model.id == row_id))).one_or_none()
+    if row is None:
+        raise HTTPException(404)
+    return json_body_response(request, {
+        'success': True,
+        key: dict(zip(fields, row))
+    }, 200, etag, updated_at)
+
+
+@requires_auth('get:actor')
+async def get_actors(request, payload):
+    return await list_rows(request, 'actors', Actor)
+
+
+@requires_auth('get:movies')
+async def get_movies(request, payload):
+    return await list_rows(request, 'movies', Movie)
+
+
+@requires_auth('get:actor')
+async def get_actor(request, payload):
+    return await get_row(request, 'actor', Actor,
+                         request.path_params['actor_id'])
+
+
+@requires_auth('get:movies')
+async def get_movie(request, payload):
+    return await get_row(request, 'movie', Movie,
+                         request.path_params['movie_id'])
+
+
+# Error handling
+async def http_error(request, error):
+    return Response(dumps({
+        'success': False,
+        'error': error.status_code,
+        'message': ERROR_MESSAGES.get(error.status_code, error.detail)
+    }), status_code=error.status_code, media_type='application/json')
+
+
+async def auth_error(request, error):
+    return Response(dumps({
+        'success': False,
+        'error': error.status_code,
+        'message': error.error['description']
+    }), status_code=error.status_code, media_type='application/json')
+
+
+native = Starlette(
+    routes=[
+        Route('/actors', get_actors),
+        Route('/movies', get_movies),
+        Route('/actors/{actor_id:int}', get_actor),
+        Route('/movies/{movie_id:int}', get_movie),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'],
+                   allow_methods=['*'], allow_headers=['*']),
+    ],
+    exception_handlers={
+        HTTPException: http_error,
+        AuthError: auth_error,
+    },
+    on_shutdown=[database.dispose],
+)
+
+
+class Dispatcher(object):
+    """
+    ASGI app sending the requests the native routes serve to them, and
+    all others to the Flask app
+    """
+
+    def __init__(self, native, fallback):
+        self.native = native
+        self.fallback = fallback
+
+    def serves(self, scope):
+        if scope['method'] not in ('GET', 'HEAD'):
+            return False
+        if not any(route.matches(scope)[0] == Match.FULL
+                   for route in self.native.routes):
+            return False
+        if scope['path'] in ('/actors', '/movies') and \
+                flask_app.config['COUNT_DEFAULT'] != 'none':
+            return False
+        query = scope['query_string'].decode('latin-1')
+        names = set(part.split('=', 1)[0] for part in query.split('&'))
+        return not names & set(DELEGATED_ARGS)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan' or \
+                (scope['type'] == 'http' and self.serves(scope)):
+            await self.native(scope, receive, send)
+        else:
+            await self.fallback(scope, receive, send)
+
+
+app = Dispatcher(native, WSGIMiddleware(flask_app))
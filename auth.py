@@ -1,5 +1,11 @@
+import asyncio
+import inspect
 import os
 import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
@@ -10,6 +16,20 @@ AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
 API_AUDIENCE = os.environ.get('API_AUDIENCE')
 ALGORITHMS = ['RS256']
 
+# JWKS location, defaults to the tenant endpoint but can point at a
+# local file:// or stub endpoint for testing
+JWKS_URL = os.environ.get('JWKS_URL') or \
+    f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
+# seconds a fetched key set is trusted before it is fetched again
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 3600))
+# minimum seconds between refreshes triggered by an unknown kid
+JWKS_MIN_REFRESH_INTERVAL = int(
+    os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+JWKS_FETCH_TIMEOUT = int(os.environ.get('JWKS_FETCH_TIMEOUT', 5))
+# verified tokens kept in memory and the longest time one is trusted
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_MAX_TTL = int(os.environ.get('TOKEN_CACHE_MAX_TTL', 300))
+
 
 # AuthError Exception
 '''
@@ -24,10 +44,212 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS key store
+class JWKSKeyStore(object):
+    """
+    In-process cache of the signing keys published by Auth0, indexed by kid
+
+    The key set is fetched once and trusted for `ttl` seconds. A token
+    signed with an unknown kid triggers a refresh (key rotation), at most
+    once every `min_refresh_interval` seconds so that forged tokens cannot
+    cause a fetch storm. Concurrent refreshes from several threads are
+    coalesced into a single fetch.
+    """
+
+    def __init__(self, url, ttl=JWKS_CACHE_TTL,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._last_refresh = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._rotation_listeners = []
+
+    def add_rotation_listener(self, listener):
+        """
+        Register a callable invoked whenever a refresh changes the key set
+        """
+        self._rotation_listeners.append(listener)
+
+    def fetch(self):
+        """
+        Download and parse the JWKS document
+        :return dict of rsa keys indexed by kid
+        """
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+        return {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+            for key in jwks['keys'] if 'kid' in key
+        }
+
+    def refresh(self, force=False):
+        """
+        Refetch the key set, unless another thread attempted it while
+        this one was waiting for the lock or the last refresh is too
+        recent. A failed fetch counts as an attempt: the threads waiting
+        for it, and the requests that follow, keep the stale keys for
+        min_refresh_interval seconds instead of each fetching in turn.
+        :return True if the key set was refreshed or a refresh attempted
+        """
+        generation = self._generation
+        with self._lock:
+            if self._generation != generation:
+                return True
+            now = time.monotonic()
+            if not force and self._last_refresh is not None and \
+                    now - self._last_refresh < self.min_refresh_interval:
+                return False
+            self._last_refresh = now
+            try:
+                keys = self.fetch()
+            except Exception:
+                # keep serving the keys we have if Auth0 is unreachable
+                if not self._keys:
+                    raise
+                # the expired key set is retried once min_refresh_interval
+                # has passed, not by every request
+                self._fetched_at = max(
+                    self._fetched_at,
+                    now - self.ttl + self.min_refresh_interval)
+                self._generation += 1
+                return False
+            rotated = bool(self._keys) and keys != self._keys
+            self._keys = keys
+            self._fetched_at = now
+            self._generation += 1
+            self.refreshes += 1
+        if rotated:
+            for listener in self._rotation_listeners:
+                listener()
+        return True
+
+    def get_key(self, kid):
+        """
+        Look up the rsa key for kid, refreshing the key set if it
+        expired or does not contain kid
+        :return rsa key dict, or None if kid is unknown
+        """
+        if self._fetched_at is None or \
+                time.monotonic() - self._fetched_at > self.ttl:
+            self.refresh(force=True)
+        key = self._keys.get(kid)
+        if key is not None:
+            self.hits += 1
+            return key
+        self.misses += 1
+        if self.refresh():
+            return self._keys.get(kid)
+        return None
+
+    def stats(self):
+        """returns hit/miss/refresh counters"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'keys': len(self._keys)
+        }
+
+
+# Verified token cache
+class TokenCache(object):
+    """
+    Bounded LRU of decoded payloads for tokens whose signature was verified
+
+    Entries are keyed by a hash of the raw token and expire with the
+    token's `exp` claim, capped at `max_ttl` seconds.
+    """
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, max_ttl=TOKEN_CACHE_MAX_TTL):
+        self.max_size = max_size
+        self.max_ttl = max_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        """
+        :return cached payload for token, or None if absent or expired
+        """
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def set(self, token, payload):
+        """caches a verified payload until its exp claim or max_ttl"""
+        if self.max_size <= 0:
+            return
+        expires_at = time.time() + self.max_ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """drops every cached token, e.g. after the signing keys rotate"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """returns hit/miss/eviction counters"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries)
+        }
+
+
+jwks_store = JWKSKeyStore(JWKS_URL)
+token_cache = TokenCache()
+jwks_store.add_rotation_listener(token_cache.clear)
+
+
 # Auth Header
 def get_token_auth_header():
     """ Obtains the Access token from the Authorization Header"""
-    auth_header = request.headers.get('Authorization', None)
+    return parse_auth_header(request.headers.get('Authorization', None))
+
+
+def parse_auth_header(auth_header):
+    """ Extracts the Access token from an Authorization Header value"""
     if not auth_header:
         raise AuthError({
             'code': 'authorization_header_missing',
@@ -53,16 +275,35 @@ def get_token_auth_header():
     return token
 
 
-def check_permissions(permission, payload):
+def normalize_permissions(permissions):
+    """
+    Normalizes scope strings so that e.g. 'post:Movies' matches 'post:movies'
+    :return frozenset of lower-cased permissions
+    """
+    if isinstance(permissions, str):
+        permissions = (permissions,)
+    return frozenset(
+        permission.strip().lower() for permission in permissions if permission)
+
+
+def check_permissions(permission, payload, any_of=frozenset()):
     """
     Function to check if user has permissions based on RBAC
+    :param permission: permission, or set of permissions, all required
+    :param any_of: set of permissions of which at least one is required
     """
-    if 'permissions' not in payload:
-        raise AuthError({
-            'code': 'invalid_claims',
-            'description': 'Permissions not included in JWT.'
-        }, 400)
-    if permission not in payload['permissions']:
+    if 'permission_set' not in payload:
+        if 'permissions' not in payload:
+            raise AuthError({
+                'code': 'invalid_claims',
+                'description': 'Permissions not included in JWT.'
+            }, 400)
+        payload['permission_set'] = normalize_permissions(
+            payload['permissions'])
+    granted = payload['permission_set']
+    if not isinstance(permission, frozenset):
+        permission = normalize_permissions(permission)
+    if not permission <= granted or (any_of and granted.isdisjoint(any_of)):
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -71,30 +312,22 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # REUSE THE PAYLOAD OF A TOKEN WE ALREADY VERIFIED
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
 
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
 
-    # CHOOSE OUR KEY
-    rsa_key = {}
+    # CHOOSE OUR KEY FROM THE CACHED AUTH0 PUBLIC KEYS
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
 
     # Finally, verify!!!
     if rsa_key:
@@ -108,6 +341,11 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
+            # built once per token, permission checks are set lookups
+            if 'permissions' in payload:
+                payload['permission_set'] = normalize_permissions(
+                    payload['permissions'])
+            token_cache.set(token, payload)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -136,7 +374,10 @@ def verify_decode_jwt(token):
 @requires_auth(permission) decorator method
     @INPUTS
         permission: string permission (i.e. 'post:drink')
+        all_of: permissions that are all required
+        any_of: permissions of which at least one is required
 
+    permissions are normalized once, when the decorator is applied
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
     it should use the check_permissions method validate claims and check the requested permission
@@ -144,13 +385,41 @@ def verify_decode_jwt(token):
 '''
 
 
-def requires_auth(permission=''):
+def _requires_auth_async(f, required, alternatives):
+    """
+    requires_auth for the coroutines of the ASGI app, which take the
+    request first. Tokens missing from token_cache are verified in the
+    default executor, so a JWKS fetch does not block the event loop.
+    """
+    @wraps(f)
+    async def wrapper(request, *args, **kwargs):
+        token = parse_auth_header(request.headers.get('Authorization'))
+        payload = token_cache.get(token)
+        if payload is None:
+            payload = await asyncio.get_running_loop().run_in_executor(
+                None, verify_decode_jwt, token)
+        check_permissions(required, payload, alternatives)
+        request.state.current_user = payload
+        return await f(request, payload, *args, **kwargs)
+
+    return wrapper
+
+
+def requires_auth(permission='', all_of=(), any_of=()):
+    required = normalize_permissions(permission) | \
+        normalize_permissions(all_of)
+    alternatives = normalize_permissions(any_of)
+
     def requires_auth_decorator(f):
+        if inspect.iscoroutinefunction(f):
+            return _requires_auth_async(f, required, alternatives)
+
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
             payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            check_permissions(required, payload, alternatives)
+            _request_ctx_stack.top.current_user = payload
             return f(payload, *args, **kwargs)
 
         return wrapper
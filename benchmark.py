@@ -0,0 +1,273 @@
+"""
+Micro-benchmarks for the casting agency api
+
+Run against a disposable database, tables are seeded as needed:
+  `BENCHMARK_DATABASE_URL=postgresql://localhost/casting_bench \\
+   python benchmark.py hydration --rows 100000`
+The load benchmark starts gunicorn itself, and also needs a token with
+get:actor in BENCHMARK_JWT.
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import threading
+import time
+from datetime import datetime, timedelta
+
+# must be set before the app module reads its configuration
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCHMARK_DATABASE_URL') or os.environ.get('TEST_DATABASE_URL') or ''
+
+from flask import jsonify  # noqa: E402
+from app import app  # noqa: E402
+from models import db, Actor  # noqa: E402
+from queries import (  # noqa: E402
+    compile_filters, encode_cursor, keyset_page, rows_to_dicts,
+    select_columns)
+import responses  # noqa: E402
+
+
+def timed(label, rows, f, repeat=3):
+    """runs f repeat times and prints the best rows/sec"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f'{label:<32} {best * 1000:10.1f} ms {rows / best:14,.0f} rows/sec')
+
+
+def latency(label, f, repeat=5):
+    """runs f repeat times and prints the median and worst latency"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    print(f'{label:<40} {samples[len(samples) // 2] * 1000:8.2f} ms median'
+          f' {samples[-1] * 1000:8.2f} ms worst')
+
+
+def throughput(label, samples, elapsed, statuses):
+    """
+    prints requests/sec, the p50 and p99 latency of samples and the
+    number of responses that were not a 200
+    """
+    samples.sort()
+    p50 = samples[len(samples) // 2]
+    p99 = samples[min(len(samples) - 1, len(samples) * 99 // 100)]
+    print(f'{label:<32} {len(samples) / elapsed:10,.0f} req/sec'
+          f' {p50 * 1000:8.2f} ms p50 {p99 * 1000:8.2f} ms p99'
+          f' {sum(status != 200 for status in statuses):6} errors')
+
+
+def seed_actors(rows):
+    """tops up the actors table to at least rows rows"""
+    db.create_all(app=app)
+    existing = Actor.query.count()
+    batch = []
+    for i in range(existing, rows):
+        batch.append({'name': f'actor{i}', 'age': 18 + i % 60,
+                      'gender': 'FM'[i % 2]})
+        if len(batch) == 10000:
+            db.session.execute(Actor.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(Actor.__table__.insert(), batch)
+    db.session.commit()
+    return max(existing, rows)
+
+
+def bench_hydration(args):
+    """ORM instances plus format() against the column-only read path"""
+    rows = seed_actors(args.rows)
+
+    def orm():
+        [row.format() for row in Actor.query.order_by(Actor.id).all()]
+
+    def columns():
+        rows_to_dicts(select_columns(Actor).order_by(Actor.id).all(),
+                      Actor.format_fields)
+
+    timed('orm objects + format()', rows, orm)
+    timed('column rows + dict(zip())', rows, columns)
+
+
+def bench_bulk_insert(args):
+    """one Actor.insert() per row against Actor.bulk_insert()"""
+    db.create_all(app=app)
+    rows = [{'name': f'bulk{i}', 'age': 18 + i % 60, 'gender': 'FM'[i % 2]}
+            for i in range(args.rows)]
+
+    def single():
+        for row in rows:
+            Actor(**row).insert()
+
+    timed('Actor.insert() per row', len(rows), single, repeat=1)
+    timed('Actor.bulk_insert()', len(rows),
+          lambda: Actor.bulk_insert(rows), repeat=1)
+
+
+def bench_search(args):
+    """latency of the first and a deep page of filtered actor searches"""
+    seed_actors(args.rows)
+    db.session.execute(db.text('ANALYZE actors'))
+    searches = [
+        {'name_prefix': 'actor1234'},
+        {'name_contains': '99'},
+        {'age_min': 25, 'age_max': 30},
+        {'gender': 'F', 'age_min': 70},
+    ]
+    deep = args.rows // 2
+    for filters in searches:
+        query = select_columns(Actor).filter(compile_filters(Actor, filters))
+        label = ' '.join(f'{k}={v}' for k, v in filters.items())
+        latency(label, lambda: keyset_page(query, Actor.id, 50))
+        latency(label + ' (deep page)',
+                lambda: keyset_page(query, Actor.id, 50, deep))
+
+
+def bench_encode(args):
+    """encode throughput of a movies payload for each JSON backend"""
+    start = datetime(2000, 1, 1)
+    rows = args.rows
+    payload = {
+        'success': True,
+        'movies': [{
+            'id': i,
+            'title': f'movie{i}',
+            'release_date': start + timedelta(days=i, seconds=i)
+        } for i in range(rows)]
+    }
+    with app.test_request_context():
+        timed('flask jsonify', rows, lambda: jsonify(payload).get_data())
+    for name in sorted(responses.JSON_ENCODERS):
+        if name == 'orjson' and responses.orjson is None:
+            print('orjson                           not installed')
+            continue
+        encoder = responses.JSON_ENCODERS[name]
+        timed(name, rows, lambda: encoder(payload))
+
+
+def start_server(worker_class, module, port, workers):
+    """
+    Starts gunicorn with gunicorn.conf.py on port, the response cache off
+    so every request reaches the database and workers not recycled
+    :return the gunicorn process, once it accepts connections
+    """
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=worker_class,
+               RESPONSE_CACHE_URL='', GUNICORN_MAX_REQUESTS='0')
+    server = subprocess.Popen(
+        ['gunicorn', '-c', 'gunicorn.conf.py',
+         '--bind', f'127.0.0.1:{port}', '--workers', str(workers), module],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'gunicorn {worker_class} exited')
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f'gunicorn {worker_class} did not start')
+
+
+def http_load(port, paths, headers, concurrency):
+    """
+    Sends paths over concurrency keep-alive connections, each waiting for
+    its response before sending the next request
+    :return latency samples, statuses and elapsed seconds
+    """
+    pending = list(paths)
+    samples, statuses = [], []
+    lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        while True:
+            with lock:
+                if not pending:
+                    break
+                path = pending.pop()
+            sent = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            except ConnectionError:
+                # the server closed the idle keep-alive connection
+                connection.close()
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+            response.read()
+            with lock:
+                samples.append(time.perf_counter() - sent)
+                statuses.append(response.status)
+        connection.close()
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, statuses, time.perf_counter() - start
+
+
+def bench_load(args):
+    """
+    Actor pages over HTTP from gunicorn running app.py on gthread workers
+    and asgi.py on uvicorn workers, --workers of each, with --concurrency
+    requests in flight
+    """
+    rows = seed_actors(args.rows)
+    db.session.remove()
+    token = os.environ.get('BENCHMARK_JWT') or os.environ.get('ASSISTANT_JWT')
+    headers = {'Authorization': f'Bearer {token}'}
+    # distinct cursors, so nothing is answered from a cache
+    paths = [f'/actors?limit=50&cursor={encode_cursor(i * 37 % rows)}'
+             for i in range(args.requests)]
+    servers = [
+        ('gthread', 'app:app'),
+        ('uvicorn.workers.UvicornWorker', 'asgi:app'),
+    ]
+    for worker_class, module in servers:
+        server = start_server(worker_class, module, args.port, args.workers)
+        try:
+            # opens the pooled connections and fetches the signing keys
+            http_load(args.port, paths[:args.concurrency * 2], headers,
+                      args.concurrency)
+            samples, statuses, elapsed = http_load(
+                args.port, paths, headers, args.concurrency)
+        finally:
+            server.terminate()
+            server.wait()
+        throughput(f'{worker_class.split(".")[-1]}, {args.workers} workers',
+                   samples, elapsed, statuses)
+
+
+BENCHMARKS = {
+    'bulk-insert': bench_bulk_insert,
+    'encode': bench_encode,
+    'hydration': bench_hydration,
+    'load': bench_load,
+    'search': bench_search,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    with app.app_context():
+        BENCHMARKS[args.benchmark](args)
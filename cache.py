@@ -0,0 +1,245 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, make_response, request
+from compression import compress_response, negotiate_encoding
+from config import Config
+
+
+# Cache backends
+class MemoryBackend(object):
+    """
+    In-process LRU with per-entry TTL, suited to a single worker process
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _store(self, key, value, ttl):
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def add(self, key, value):
+        """stores value unless key exists"""
+        with self._lock:
+            if key not in self._entries:
+                self._store(key, value, None)
+
+    def incr(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            value = int(entry[0]) + 1 if entry else time.time_ns()
+            self._store(key, value, None)
+            return value
+
+
+class RedisBackend(object):
+    """
+    Backend speaking the Redis protocol, shared by every worker process.
+    Any client with the get/set/incr methods of redis-py can stand in.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ex=ttl)
+
+    def add(self, key, value):
+        self.client.set(key, value, nx=True)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+
+# Response cache
+class ResponseCache(object):
+    """
+    Caches successful GET responses keyed by route, query parameters and
+    permission set. Every table, and every row of it, has a generation
+    number that is part of the keys of the list and item routes: bumping
+    it on a write makes the affected entries unreachable, and they age
+    out of the backend. With read replicas, set to the ReplicaSet by
+    RoutingSQLAlchemy, responses read from a replica that may lag behind
+    a write are not stored, so a page missing the write is never cached
+    under the generation that follows it.
+    """
+
+    def __init__(self, backend, ttl=60, prefix='casting'):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+        self.replicas = None
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_url(cls, url, ttl=60, max_entries=1024):
+        """
+        Builds the cache for `memory://` or `redis://...`
+        :return ResponseCache, or None for an empty url (caching off)
+        """
+        if not url:
+            return None
+        if url.startswith('memory:'):
+            return cls(MemoryBackend(max_entries), ttl)
+        return cls(RedisBackend.from_url(url), ttl)
+
+    def _generation(self, *parts):
+        key = ':'.join([self.prefix, 'generation'] + [str(p) for p in parts])
+        generation = self.backend.get(key)
+        if generation is None:
+            # never reuse a number an evicted generation could have had
+            self.backend.add(key, time.time_ns())
+            generation = self.backend.get(key)
+        return int(generation)
+
+    def key(self, table, row_id=None, permissions=(), encoding=None,
+            related=None):
+        """
+        returns the cache key of the current request, which changes with
+        the generation of the related table too when one is given
+        """
+        if row_id is None:
+            generation = self._generation(table)
+        else:
+            generation = self._generation(table, row_id)
+        if related is not None:
+            generation = f'{generation}.{self._generation(related)}'
+        request_key = repr((
+            request.path,
+            sorted(request.args.items(multi=True)),
+            sorted(permissions),
+            encoding
+        ))
+        return ':'.join([
+            self.prefix, 'response', table, str(generation),
+            hashlib.sha1(request_key.encode('utf-8')).hexdigest()
+        ])
+
+    def invalidate(self, table, row_id=None):
+        """
+        Makes the cached lists of table, and the cached item row_id, stale
+        Example
+          `response_cache.invalidate('actors', actor.id)`
+        """
+        self.backend.incr(':'.join([self.prefix, 'generation', table]))
+        if self.replicas is not None:
+            self.replicas.mark_written(table)
+        if row_id is not None:
+            self.backend.incr(
+                ':'.join([self.prefix, 'generation', table, str(row_id)]))
+
+    @staticmethod
+    def _dump(response):
+        headers = {
+            name: value for name, value in response.headers.items()
+            if name in ('ETag', 'Last-Modified', 'Cache-Control',
+                        'Content-Encoding', 'Vary')
+        }
+        meta = json.dumps({'mimetype': response.mimetype, 'headers': headers})
+        return meta.encode('utf-8') + b'\n' + response.get_data()
+
+    @staticmethod
+    def _load(entry):
+        meta, body = entry.split(b'\n', 1)
+        meta = json.loads(meta.decode('utf-8'))
+        return Response(body, status=200, headers=meta['headers'],
+                        mimetype=meta['mimetype'])
+
+    def cached(self, table, related=()):
+        """
+        Decorator serving GET views from the cache, applied below
+        requires_auth so the permission set is part of the key. Entries
+        are stored compressed with the negotiated encoding, which is part
+        of the key too. related names the tables the view embeds with
+        `include`, whose writes make those responses stale as well.
+        Example
+          `@response_cache.cached('actors', related=('movies',))`
+        """
+        def cached_decorator(f):
+            @wraps(f)
+            def wrapper(payload, *args, **kwargs):
+                row_id = next(iter(kwargs.values()), None)
+                encoding = negotiate_encoding()
+                include = request.args.get('include')
+                if include not in related:
+                    include = None
+                key = self.key(
+                    table, row_id, payload.get('permission_set', ()),
+                    encoding, include)
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    return self._load(entry).make_conditional(request)
+                self.misses += 1
+                response = make_response(f(payload, *args, **kwargs))
+                if response.status_code == 200 and \
+                        not response.is_streamed and \
+                        (self.replicas is None or
+                         (self.replicas.settled(table) and
+                          (include is None or
+                           self.replicas.settled(include)))):
+                    compress_response(response, encoding)
+                    self.backend.set(key, self._dump(response), self.ttl)
+                return response
+
+            return wrapper
+        return cached_decorator
+
+    def stats(self):
+        """returns hit/miss counters"""
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+response_cache = ResponseCache.from_url(
+    Config.RESPONSE_CACHE_URL, Config.RESPONSE_CACHE_TTL,
+    Config.RESPONSE_CACHE_MAX_ENTRIES)
+
+
+def cached(table, related=()):
+    """
+    Decorator caching a GET view in response_cache, a no-op when caching
+    is turned off
+    """
+    if response_cache is None:
+        return lambda f: f
+    return response_cache.cached(table, related)
+
+
+def invalidate(table, row_id=None):
+    """invalidates response_cache after a write to table"""
+    if response_cache is not None:
+        response_cache.invalidate(table, row_id)
@@ -0,0 +1,128 @@
+import zlib
+from flask import request
+from werkzeug.http import parse_accept_header
+from config import Config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content codings offered to clients, preferred first on equal quality
+ENCODINGS = tuple(
+    encoding for encoding in Config.COMPRESS_ENCODINGS
+    if encoding == 'gzip' or (encoding == 'br' and brotli is not None))
+
+COMPRESSIBLE_MIMETYPES = frozenset((
+    'application/json', 'application/x-ndjson', 'text/csv', 'text/plain',
+))
+
+
+# Compressors
+class _GzipCompressor(object):
+    def __init__(self):
+        # wbits 16 + 15 writes the gzip header and trailer
+        self._compressor = zlib.compressobj(
+            Config.COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliCompressor(object):
+    def __init__(self):
+        self._compressor = brotli.Compressor(
+            mode=brotli.MODE_TEXT, quality=Config.BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+COMPRESSORS = {
+    'gzip': _GzipCompressor,
+    'br': _BrotliCompressor,
+}
+
+
+def compress_bytes(data, encoding):
+    """returns data compressed with encoding ('gzip' or 'br')"""
+    compressor = COMPRESSORS[encoding]()
+    return compressor.compress(data) + compressor.finish()
+
+
+def compress_chunks(chunks, encoding):
+    """
+    Compresses an iterable of byte chunks, flushing after every chunk so
+    each one reaches the client as soon as it is produced
+    """
+    compressor = COMPRESSORS[encoding]()
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+# Negotiation
+def negotiate_encoding(accept_encoding=None):
+    """
+    Picks the content coding from an Accept-Encoding header value, by
+    default the one of the current request
+    :return 'br', 'gzip' or None for identity
+    """
+    if not ENCODINGS:
+        return None
+    if accept_encoding is None:
+        accept = request.accept_encodings
+    else:
+        accept = parse_accept_header(accept_encoding)
+    return accept.best_match(ENCODINGS)
+
+
+def compress_response(response, encoding=None):
+    """
+    Compresses response in place with the negotiated encoding. Bodies
+    smaller than COMPRESS_MIN_SIZE stay uncompressed, streamed bodies are
+    compressed chunk by chunk whatever their size. Registered as an
+    after_request hook, and called by the response cache before storing
+    a response so cached entries hold the compressed bytes.
+    Example
+      `app.after_request(compress_response)`
+    """
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or \
+            'Content-Encoding' in response.headers or \
+            response.status_code < 200 or \
+            response.status_code in (204, 206, 304):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = encoding or negotiate_encoding()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_chunks(
+            response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < Config.COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress_bytes(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # the compressed bytes are a different representation of the same
+    # resource, a weak validator still matches the identity one
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -1,6 +1,100 @@
 import os
+from pooling import InstrumentedQueuePool
+
+
+def database_url(url):
+  """
+  Renames the postgres:// scheme set by Heroku to postgresql://, the
+  only one SQLAlchemy 1.4 accepts
+  """
+  if url and url.startswith('postgres://'):
+    return 'postgresql://' + url[len('postgres://'):]
+  return url
+
+
+def engine_options(url, asyncio=False):
+  """
+  Pool and statement timeout of the PostgreSQL engine, from the DB_*
+  environment variables; other databases keep the defaults. With
+  asyncio, the options of an asyncpg engine.
+  """
+  if not url or not url.startswith('postgres'):
+    return {}
+  statement_timeout = int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))
+  options = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+  }
+  if asyncio:
+    options['connect_args'] = {
+      'server_settings': {'statement_timeout': str(statement_timeout)}
+    }
+  else:
+    options['poolclass'] = InstrumentedQueuePool
+    options['connect_args'] = {
+      'options': '-c statement_timeout={}'.format(statement_timeout)
+    }
+  return options
+
 
 class Config(object):
   SECRET_KEY = os.environ.get('SECRET_KEY') or 'udacitycapstone'
-  SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
-  SQLALCHEMY_TRACK_MODIFICATIONS = False
\ No newline at end of file
+  SQLALCHEMY_DATABASE_URI = database_url(os.environ.get('DATABASE_URL'))
+  SQLALCHEMY_TRACK_MODIFICATIONS = False
+  # one engine and pool per worker process, see engine_options
+  SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+  # comma separated read replicas serving GET requests, empty for none
+  DATABASE_REPLICA_URLS = tuple(
+      database_url(url) for url in os.environ.get(
+          'DATABASE_REPLICA_URLS', '').split(',') if url)
+  # seconds a client reads from the primary after its own write
+  REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 10))
+  # seconds between the background health checks of the replicas
+  REPLICA_HEALTH_INTERVAL = int(os.environ.get('REPLICA_HEALTH_INTERVAL', 10))
+  # seconds a health check waits to connect to a replica
+  REPLICA_CONNECT_TIMEOUT = int(os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+  # keyset pagination of the list endpoints
+  PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+  MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 500))
+  # rows fetched per round-trip by the streaming export endpoints
+  EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+  # response cache for the read endpoints, off unless set: memory:// for
+  # a single worker process, redis://host:port/db shared by all workers
+  RESPONSE_CACHE_URL = os.environ.get('RESPONSE_CACHE_URL', '')
+  RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 60))
+  RESPONSE_CACHE_MAX_ENTRIES = int(
+      os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1024))
+  # most items accepted by one bulk request
+  BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 10000))
+  # most rows one bulk PATCH or DELETE may change
+  BULK_MAX_ROWS = int(os.environ.get('BULK_MAX_ROWS', 1000))
+  # most ids resolved by one ?ids= request
+  MAX_IDS = int(os.environ.get('MAX_IDS', 100))
+  # default source of GET /stats: 'summary' counters or 'live' GROUP BY
+  STATS_SOURCE = os.environ.get('STATS_SOURCE', 'summary')
+  # seconds between two folds of the journaled stats deltas into the
+  # counters by each process, after a write
+  STATS_FOLD_INTERVAL = int(os.environ.get('STATS_FOLD_INTERVAL', 10))
+  # total count of the list endpoints: 'exact', 'estimated', 'cached'
+  # (exact, memoized for COUNT_CACHE_TTL seconds) or 'none'
+  COUNT_DEFAULT = os.environ.get('COUNT_DEFAULT', 'none')
+  COUNT_CACHE_TTL = int(os.environ.get('COUNT_CACHE_TTL', 60))
+  # negotiated response compression: codings offered in order of
+  # preference ('br' needs the brotli package), empty to turn it off
+  COMPRESS_ENCODINGS = tuple(filter(None, os.environ.get(
+      'COMPRESS_ENCODINGS', 'br,gzip').split(',')))
+  # smallest body compressed, streamed bodies are always compressed
+  COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+  COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+  BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+  # Idempotency-Key of POST /actors and POST /movies: seconds a response
+  # is replayed, seconds before a key whose request never finished can be
+  # claimed again, and seconds between expiry sweeps of each process
+  IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400))
+  IDEMPOTENCY_INFLIGHT_TIMEOUT = int(
+      os.environ.get('IDEMPOTENCY_INFLIGHT_TIMEOUT', 60))
+  IDEMPOTENCY_SWEEP_INTERVAL = int(
+      os.environ.get('IDEMPOTENCY_SWEEP_INTERVAL', 300))
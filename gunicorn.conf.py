@@ -0,0 +1,113 @@
+"""
+Gunicorn settings of the api, e.g.
+  `gunicorn -c gunicorn.conf.py app:app`
+  `GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker \\
+   gunicorn -c gunicorn.conf.py asgi:app`
+
+Every setting can be overridden from the environment, WEB_CONCURRENCY
+being the worker count Heroku sets for the dyno size.
+"""
+import multiprocessing
+import os
+import sys
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8000))
+
+# sync, gthread (default), gevent (needs the gevent package, and
+# psycogreen so queries yield to other greenlets) or
+# uvicorn.workers.UvicornWorker for asgi:app
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+
+# a sync worker serves one request at a time and mostly waits on the
+# database, the other classes wait concurrently within one process
+if worker_class == 'sync':
+    default_workers = multiprocessing.cpu_count() * 2 + 1
+else:
+    default_workers = multiprocessing.cpu_count()
+workers = int(os.environ.get('WEB_CONCURRENCY') or
+              os.environ.get('GUNICORN_WORKERS') or default_workers)
+
+# one thread per pooled connection, so requests do not queue for one;
+# sync workers keep one thread, as gunicorn turns a sync worker with more
+# into gthread and the worker count above assumes one request each
+if worker_class == 'gthread':
+    threads = int(os.environ.get('GUNICORN_THREADS') or
+                  os.environ.get('DB_POOL_SIZE') or 5)
+else:
+    threads = 1
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# importing the app once in the master shares its memory between the
+# workers and fails fast on a broken deploy; gevent workers must import
+# it after monkey patching, so they load it themselves
+preload_app = os.environ.get(
+    'GUNICORN_PRELOAD', '0' if worker_class == 'gevent' else '1') != '0'
+
+# workers are replaced after max_requests requests, plus a random
+# jitter so they do not all restart at once, which bounds the growth of
+# their caches and of any leak
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# heartbeat files on tmpfs, a disk-backed /tmp can stall workers
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+
+
+def on_starting(server):
+    """
+    Refuses to start several workers that would each keep their own
+    response cache or read-your-writes pins: a worker would serve a stale
+    response, or a replica read, after a write handled by another one.
+    """
+    from config import Config
+    if server.cfg.workers <= 1 or \
+            Config.RESPONSE_CACHE_URL.startswith('redis'):
+        return
+    if Config.RESPONSE_CACHE_URL.startswith('memory:'):
+        reason = 'RESPONSE_CACHE_URL is memory://'
+    elif Config.DATABASE_REPLICA_URLS:
+        reason = 'DATABASE_REPLICA_URLS is set without a redis:// ' \
+            'RESPONSE_CACHE_URL to share the read-your-writes pins'
+    else:
+        return
+    server.log.error(
+        '%s with %d workers, whose caches are not shared. Set a redis:// '
+        'RESPONSE_CACHE_URL, an empty one to turn caching off, or run one '
+        'worker.', reason, server.cfg.workers)
+    sys.exit(1)
+
+
+def post_fork(server, worker):
+    """
+    Drops the database connections the worker inherited from the master,
+    which may have opened them while preloading the app, so two
+    processes never share a socket. close=False leaves them open for the
+    master.
+    """
+    app = sys.modules.get('app')
+    if app is None:
+        return
+    from models import db
+    db.get_engine(app.app).dispose(close=False)
+    for replica in db.replicas.replicas:
+        replica.engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    if worker.cfg.worker_class_str == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            worker.log.warning(
+                'psycogreen is not installed, queries block the gevent '
+                'worker')
+        else:
+            patch_psycopg()
@@ -0,0 +1,98 @@
+import hashlib
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import Response, abort, current_app, make_response, request
+from models import IdempotencyKey
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+# monotonic time of the last expiry sweep of this process
+_last_sweep = 0.0
+
+
+def request_hash():
+    """returns the sha256 of the method, path and body of the request"""
+    digest = hashlib.sha256()
+    for part in (request.method, request.full_path):
+        digest.update(part.encode('utf-8') + b'\n')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _sweep():
+    """sweeps expired keys at most every IDEMPOTENCY_SWEEP_INTERVAL
+    seconds per process"""
+    global _last_sweep
+    now = time.monotonic()
+    if now - _last_sweep < current_app.config['IDEMPOTENCY_SWEEP_INTERVAL']:
+        return
+    _last_sweep = now
+    IdempotencyKey.sweep(current_app.config['IDEMPOTENCY_KEY_TTL'],
+                         current_app.config['IDEMPOTENCY_INFLIGHT_TIMEOUT'])
+
+
+def _expired(row):
+    if row.status is None:
+        ttl = current_app.config['IDEMPOTENCY_INFLIGHT_TIMEOUT']
+    else:
+        ttl = current_app.config['IDEMPOTENCY_KEY_TTL']
+    return row.created_at < datetime.utcnow() - timedelta(seconds=ttl)
+
+
+def _replay(row):
+    response = Response(row.response, status=row.status,
+                        mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(f):
+    """
+    Decorator making a POST view safe to retry: the first request with
+    an Idempotency-Key header runs the view and records its response,
+    retries with the same key and body get the recorded response without
+    running the view again. A retry while the first request is still
+    running is a 409, reusing a key for a different request is a 422.
+    Errors and 5xx responses are not recorded, so they can be retried.
+    Applied below requires_auth, keys are scoped to the jwt subject.
+    Example
+      `@idempotent`
+    """
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if key is None:
+            return f(payload, *args, **kwargs)
+        if not key or len(key) > 255:
+            abort(400)
+        _sweep()
+        principal = payload.get('sub', '')
+        digest = request_hash()
+        if not IdempotencyKey.claim(principal, key, digest):
+            row = IdempotencyKey.lookup(principal, key)
+            if row is None or _expired(row):
+                # released or expired since: one more try at claiming it
+                if row is not None:
+                    IdempotencyKey.release(principal, key, row.created_at)
+                if not IdempotencyKey.claim(principal, key, digest):
+                    abort(409)
+            elif row.request_hash != digest:
+                abort(422)
+            elif row.status is None:
+                abort(409)
+            else:
+                return _replay(row)
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except Exception:
+            IdempotencyKey.release(principal, key)
+            raise
+        if response.status_code >= 500 or response.is_streamed:
+            IdempotencyKey.release(principal, key)
+        else:
+            IdempotencyKey.store(principal, key, response.status_code,
+                                 response.get_data())
+        return response
+
+    return wrapper
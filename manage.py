@@ -1,13 +1,107 @@
-from flask_script import Manager
+import sys
+from flask_script import Command, Manager, Option
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models import db
+from models import db, fold_stats, Actor, IdempotencyKey, Movie
+from transfer import (
+    COPY_CHUNK_SIZE, FORMATS, InvalidRow, Progress, export_rows, format_of,
+    import_rows)
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 
+
+class SweepIdempotencyKeys(Command):
+    """deletes the expired idempotency keys"""
+
+    def run(self):
+        count = IdempotencyKey.sweep(
+            app.config['IDEMPOTENCY_KEY_TTL'],
+            app.config['IDEMPOTENCY_INFLIGHT_TIMEOUT'])
+        print(f'deleted {count} idempotency keys')
+
+
+class FoldStats(Command):
+    """folds the stats deltas journaled by the triggers into the counters"""
+
+    def run(self):
+        print(f'folded {fold_stats()} stats deltas')
+
+
+class ImportRows(Command):
+    """loads rows from a CSV or NDJSON file with COPY FROM STDIN"""
+
+    option_list = (
+        Option('path', help='file to load, - for stdin'),
+        Option('--format', dest='fmt', choices=FORMATS,
+               help='csv or ndjson, by default from the file extension'),
+        Option('--chunk-size', dest='chunk_size', type=int,
+               default=COPY_CHUNK_SIZE, help='rows per COPY statement'),
+        Option('--skip-invalid', dest='skip_invalid', action='store_true',
+               help='skip invalid rows instead of loading nothing'),
+    )
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def run(self, path, fmt, chunk_size, skip_invalid):
+        fmt = format_of(path, fmt)
+        lines = sys.stdin if path == '-' else open(path, newline='')
+        progress = Progress(f'import {self.model.__tablename__}')
+        try:
+            loaded, skipped = import_rows(
+                self.model, lines, fmt, chunk_size, skip_invalid, progress)
+        except (InvalidRow, RuntimeError) as error:
+            progress.done()
+            print(f'nothing imported, {error}', file=sys.stderr)
+            return 1
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+        progress.done()
+        print(f'imported {loaded} rows, skipped {skipped} invalid rows',
+              file=sys.stderr)
+
+
+class ExportRows(Command):
+    """writes all rows as CSV or NDJSON with COPY TO STDOUT"""
+
+    option_list = (
+        Option('path', nargs='?', default='-',
+               help='file to write, - (default) for stdout'),
+        Option('--format', dest='fmt', choices=FORMATS,
+               help='csv or ndjson, by default from the file extension'),
+    )
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def run(self, path, fmt):
+        fmt = format_of(path, fmt)
+        out = sys.stdout.buffer if path == '-' else open(path, 'wb')
+        progress = Progress(f'export {self.model.__tablename__}')
+        try:
+            export_rows(self.model, out, fmt, progress)
+        except RuntimeError as error:
+            print(error, file=sys.stderr)
+            return 1
+        finally:
+            out.flush()
+            if out is not sys.stdout.buffer:
+                out.close()
+        progress.done()
+
+
 manager.add_command('db', MigrateCommand)
+manager.add_command('sweep_idempotency_keys', SweepIdempotencyKeys())
+manager.add_command('fold_stats', FoldStats())
+manager.add_command('import-actors', ImportRows(Actor))
+manager.add_command('import-movies', ImportRows(Movie))
+manager.add_command('export-actors', ExportRows(Actor))
+manager.add_command('export-movies', ExportRows(Movie))
 
 if __name__ == '__main__':
     manager.run()
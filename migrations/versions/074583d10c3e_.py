@@ -0,0 +1,49 @@
+"""count write statements on actors and movies for the validators
+
+Revision ID: 074583d10c3e
+Revises: ed944f47992a
+Create Date: 2026-10-18 17:05:12.846310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '074583d10c3e'
+down_revision = 'ed944f47992a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # every write statement adds 1 to the table_writes counter of its
+    # table, journaled in stats_deltas like the stats so writers take no
+    # shared lock; the count is the validator of the list endpoints
+    op.execute("""
+        CREATE FUNCTION table_writes() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO stats_deltas (dimension, bucket, delta)
+            VALUES ('table_writes', TG_TABLE_NAME, 1);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER actors_writes
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON actors
+        FOR EACH STATEMENT EXECUTE PROCEDURE table_writes();
+
+        CREATE TRIGGER movies_writes
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON movies
+        FOR EACH STATEMENT EXECUTE PROCEDURE table_writes();
+    """)
+
+
+def downgrade():
+    op.execute("""
+        DROP TRIGGER movies_writes ON movies;
+        DROP TRIGGER actors_writes ON actors;
+        DROP FUNCTION table_writes();
+        DELETE FROM stats_deltas WHERE dimension = 'table_writes';
+        DELETE FROM stats_counters WHERE dimension = 'table_writes';
+    """)
@@ -0,0 +1,37 @@
+"""add idempotency_keys
+
+Revision ID: 25c405e90f57
+Revises: e5e8b4433604
+Create Date: 2026-10-18 14:02:37.118240
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '25c405e90f57'
+down_revision = 'e5e8b4433604'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('idempotency_keys',
+    sa.Column('principal', sa.String(), nullable=False),
+    sa.Column('key', sa.String(length=255), nullable=False),
+    sa.Column('request_hash', sa.String(length=64), nullable=False),
+    sa.Column('status', sa.Integer(), nullable=True),
+    sa.Column('response', sa.LargeBinary(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('principal', 'key')
+    )
+    # serves the expiry sweep
+    op.create_index(op.f('ix_idempotency_keys_created_at'),
+                    'idempotency_keys', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_idempotency_keys_created_at'),
+                  table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
@@ -0,0 +1,38 @@
+"""add search indexes on actors and movies
+
+Revision ID: 4979c5649dfc
+Revises: 5753fee5a56e
+Create Date: 2026-10-18 11:48:05.734210
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4979c5649dfc'
+down_revision = '5753fee5a56e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # range filters
+    op.create_index(op.f('ix_actors_age'), 'actors', ['age'], unique=False)
+    op.create_index(op.f('ix_movies_release_date'), 'movies',
+                    ['release_date'], unique=False)
+    # ILIKE prefix and substring searches
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_actors_name_trgm', 'actors', ['name'], unique=False,
+                    postgresql_using='gin',
+                    postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_movies_title_trgm', 'movies', ['title'],
+                    unique=False, postgresql_using='gin',
+                    postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
+    op.drop_index(op.f('ix_movies_release_date'), table_name='movies')
+    op.drop_index(op.f('ix_actors_age'), table_name='actors')
@@ -0,0 +1,34 @@
+"""add castings association between actors and movies
+
+Revision ID: 5753fee5a56e
+Revises: e32a81e683f6
+Create Date: 2026-10-18 11:02:47.118532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5753fee5a56e'
+down_revision = 'e32a81e683f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('castings',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    # the primary key serves lookups by movie, this one lookups by actor
+    op.create_index('ix_castings_actor_id', 'castings',
+                    ['actor_id', 'movie_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_castings_actor_id', table_name='castings')
+    op.drop_table('castings')
@@ -0,0 +1,36 @@
+"""add updated_at to actors and movies
+
+Revision ID: e32a81e683f6
+Revises: cf4866711210
+Create Date: 2026-10-18 09:12:31.402715
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e32a81e683f6'
+down_revision = 'cf4866711210'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actors', sa.Column(
+        'updated_at', sa.DateTime(), nullable=False,
+        server_default=sa.text("(now() at time zone 'utc')")))
+    op.create_index(op.f('ix_actors_updated_at'), 'actors',
+                    ['updated_at'], unique=False)
+    op.add_column('movies', sa.Column(
+        'updated_at', sa.DateTime(), nullable=False,
+        server_default=sa.text("(now() at time zone 'utc')")))
+    op.create_index(op.f('ix_movies_updated_at'), 'movies',
+                    ['updated_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_movies_updated_at'), table_name='movies')
+    op.drop_column('movies', 'updated_at')
+    op.drop_index(op.f('ix_actors_updated_at'), table_name='actors')
+    op.drop_column('actors', 'updated_at')
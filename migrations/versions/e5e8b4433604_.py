@@ -0,0 +1,117 @@
+"""add stats_counters maintained by triggers on actors and movies
+
+Revision ID: e5e8b4433604
+Revises: 4979c5649dfc
+Create Date: 2026-10-18 12:20:14.563018
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5e8b4433604'
+down_revision = '4979c5649dfc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stats_counters',
+    sa.Column('dimension', sa.String(), nullable=False),
+    sa.Column('bucket', sa.String(), nullable=False),
+    sa.Column('count', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('dimension', 'bucket')
+    )
+    # row triggers keep the counters in step with every write, including
+    # bulk statements and COPY
+    op.execute("""
+        CREATE FUNCTION stats_add(dim varchar, bucket_name varchar,
+                                  delta integer)
+        RETURNS void AS $$
+        BEGIN
+            INSERT INTO stats_counters (dimension, bucket, count)
+            VALUES (dim, bucket_name, delta)
+            ON CONFLICT (dimension, bucket)
+            DO UPDATE SET count = stats_counters.count + delta;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION stats_age_bucket(age integer) RETURNS varchar AS $$
+            SELECT (age / 10 * 10)::text || '-' || (age / 10 * 10 + 9)::text;
+        $$ LANGUAGE sql IMMUTABLE;
+
+        CREATE FUNCTION stats_release_year(release_date timestamp)
+        RETURNS varchar AS $$
+            SELECT coalesce(extract(year FROM release_date)::int::text,
+                            'unknown');
+        $$ LANGUAGE sql IMMUTABLE;
+
+        CREATE FUNCTION actors_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND OLD.gender = NEW.gender AND
+                    stats_age_bucket(OLD.age) = stats_age_bucket(NEW.age) THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM stats_add('actors_by_gender', OLD.gender, -1);
+                PERFORM stats_add('actors_by_age',
+                                  stats_age_bucket(OLD.age), -1);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM stats_add('actors_by_gender', NEW.gender, 1);
+                PERFORM stats_add('actors_by_age',
+                                  stats_age_bucket(NEW.age), 1);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION movies_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND stats_release_year(OLD.release_date) =
+                    stats_release_year(NEW.release_date) THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM stats_add('movies_by_release_year',
+                                  stats_release_year(OLD.release_date), -1);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM stats_add('movies_by_release_year',
+                                  stats_release_year(NEW.release_date), 1);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER actors_stats AFTER INSERT OR UPDATE OR DELETE
+        ON actors FOR EACH ROW EXECUTE PROCEDURE actors_stats();
+
+        CREATE TRIGGER movies_stats AFTER INSERT OR UPDATE OR DELETE
+        ON movies FOR EACH ROW EXECUTE PROCEDURE movies_stats();
+
+        INSERT INTO stats_counters (dimension, bucket, count)
+        SELECT 'actors_by_gender', gender, count(*)
+        FROM actors GROUP BY gender
+        UNION ALL
+        SELECT 'actors_by_age', stats_age_bucket(age), count(*)
+        FROM actors GROUP BY stats_age_bucket(age)
+        UNION ALL
+        SELECT 'movies_by_release_year', stats_release_year(release_date),
+               count(*)
+        FROM movies GROUP BY stats_release_year(release_date);
+    """)
+
+
+def downgrade():
+    op.execute("""
+        DROP TRIGGER movies_stats ON movies;
+        DROP TRIGGER actors_stats ON actors;
+        DROP FUNCTION movies_stats();
+        DROP FUNCTION actors_stats();
+        DROP FUNCTION stats_release_year(timestamp);
+        DROP FUNCTION stats_age_bucket(integer);
+        DROP FUNCTION stats_add(varchar, varchar, integer);
+    """)
+    op.drop_table('stats_counters')
@@ -0,0 +1,233 @@
+"""journal stats counter changes with statement triggers
+
+Revision ID: ed944f47992a
+Revises: 25c405e90f57
+Create Date: 2026-10-18 16:21:40.512377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ed944f47992a'
+down_revision = '25c405e90f57'
+branch_labels = None
+depends_on = None
+
+# row triggers of e5e8b4433604, restored by downgrade
+ROW_TRIGGERS = """
+    CREATE FUNCTION stats_add(dim varchar, bucket_name varchar,
+                              delta integer)
+    RETURNS void AS $$
+    BEGIN
+        INSERT INTO stats_counters (dimension, bucket, count)
+        VALUES (dim, bucket_name, delta)
+        ON CONFLICT (dimension, bucket)
+        DO UPDATE SET count = stats_counters.count + delta;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE FUNCTION actors_stats() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' AND OLD.gender = NEW.gender AND
+                stats_age_bucket(OLD.age) = stats_age_bucket(NEW.age) THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM stats_add('actors_by_gender', OLD.gender, -1);
+            PERFORM stats_add('actors_by_age',
+                              stats_age_bucket(OLD.age), -1);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM stats_add('actors_by_gender', NEW.gender, 1);
+            PERFORM stats_add('actors_by_age',
+                              stats_age_bucket(NEW.age), 1);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE FUNCTION movies_stats() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' AND stats_release_year(OLD.release_date) =
+                stats_release_year(NEW.release_date) THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            PERFORM stats_add('movies_by_release_year',
+                              stats_release_year(OLD.release_date), -1);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            PERFORM stats_add('movies_by_release_year',
+                              stats_release_year(NEW.release_date), 1);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER actors_stats AFTER INSERT OR UPDATE OR DELETE
+    ON actors FOR EACH ROW EXECUTE PROCEDURE actors_stats();
+
+    CREATE TRIGGER movies_stats AFTER INSERT OR UPDATE OR DELETE
+    ON movies FOR EACH ROW EXECUTE PROCEDURE movies_stats();
+"""
+
+
+def upgrade():
+    # writers only ever insert into stats_deltas, so they never wait on
+    # each other, nor on an import, for a lock on a counter row
+    op.create_table('stats_deltas',
+    sa.Column('dimension', sa.String(), nullable=False),
+    sa.Column('bucket', sa.String(), nullable=False),
+    sa.Column('delta', sa.BigInteger(), nullable=False)
+    )
+    op.create_index('ix_stats_deltas_dimension_bucket', 'stats_deltas',
+                    ['dimension', 'bucket'], unique=False)
+    # statement triggers write one delta per bucket a statement changed,
+    # however many rows it touched; transition tables are only allowed
+    # on single-event triggers, hence one trigger per event
+    op.execute("""
+        DROP TRIGGER actors_stats ON actors;
+        DROP TRIGGER movies_stats ON movies;
+        DROP FUNCTION actors_stats();
+        DROP FUNCTION movies_stats();
+        DROP FUNCTION stats_add(varchar, varchar, integer);
+
+        CREATE FUNCTION actors_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO stats_deltas (dimension, bucket, delta)
+                SELECT dimension, bucket, sum(delta)
+                FROM (SELECT 'actors_by_gender' AS dimension,
+                             gender AS bucket, 1 AS delta
+                      FROM new_rows
+                      UNION ALL
+                      SELECT 'actors_by_age', stats_age_bucket(age), 1
+                      FROM new_rows) changes
+                GROUP BY dimension, bucket;
+            ELSIF TG_OP = 'DELETE' THEN
+                INSERT INTO stats_deltas (dimension, bucket, delta)
+                SELECT dimension, bucket, sum(delta)
+                FROM (SELECT 'actors_by_gender' AS dimension,
+                             gender AS bucket, -1 AS delta
+                      FROM old_rows
+                      UNION ALL
+                      SELECT 'actors_by_age', stats_age_bucket(age), -1
+                      FROM old_rows) changes
+                GROUP BY dimension, bucket;
+            ELSE
+                INSERT INTO stats_deltas (dimension, bucket, delta)
+                SELECT dimension, bucket, sum(delta)
+                FROM (SELECT 'actors_by_gender' AS dimension,
+                             gender AS bucket, 1 AS delta
+                      FROM new_rows
+                      UNION ALL
+                      SELECT 'actors_by_age', stats_age_bucket(age), 1
+                      FROM new_rows
+                      UNION ALL
+                      SELECT 'actors_by_gender', gender, -1
+                      FROM old_rows
+                      UNION ALL
+                      SELECT 'actors_by_age', stats_age_bucket(age), -1
+                      FROM old_rows) changes
+                GROUP BY dimension, bucket
+                HAVING sum(delta) <> 0;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE FUNCTION movies_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO stats_deltas (dimension, bucket, delta)
+                SELECT 'movies_by_release_year',
+                       stats_release_year(release_date), count(*)
+                FROM new_rows
+                GROUP BY stats_release_year(release_date);
+            ELSIF TG_OP = 'DELETE' THEN
+                INSERT INTO stats_deltas (dimension, bucket, delta)
+                SELECT 'movies_by_release_year',
+                       stats_release_year(release_date), -count(*)
+                FROM old_rows
+                GROUP BY stats_release_year(release_date);
+            ELSE
+                INSERT INTO stats_deltas (dimension, bucket, delta)
+                SELECT 'movies_by_release_year', bucket, sum(delta)
+                FROM (SELECT stats_release_year(release_date) AS bucket,
+                             1 AS delta
+                      FROM new_rows
+                      UNION ALL
+                      SELECT stats_release_year(release_date), -1
+                      FROM old_rows) changes
+                GROUP BY bucket
+                HAVING sum(delta) <> 0;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER actors_stats_insert AFTER INSERT ON actors
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE actors_stats();
+        CREATE TRIGGER actors_stats_update AFTER UPDATE ON actors
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE actors_stats();
+        CREATE TRIGGER actors_stats_delete AFTER DELETE ON actors
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE actors_stats();
+
+        CREATE TRIGGER movies_stats_insert AFTER INSERT ON movies
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE movies_stats();
+        CREATE TRIGGER movies_stats_update AFTER UPDATE ON movies
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE movies_stats();
+        CREATE TRIGGER movies_stats_delete AFTER DELETE ON movies
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE movies_stats();
+
+        -- moves the deltas into stats_counters in one short transaction;
+        -- a fold already running in another session is not waited for
+        CREATE FUNCTION stats_fold() RETURNS bigint AS $$
+        DECLARE
+            folded bigint;
+        BEGIN
+            IF NOT pg_try_advisory_xact_lock(hashtext('stats_fold')) THEN
+                RETURN 0;
+            END IF;
+            WITH moved AS (
+                DELETE FROM stats_deltas
+                RETURNING dimension, bucket, delta
+            ), totals AS (
+                INSERT INTO stats_counters (dimension, bucket, count)
+                SELECT dimension, bucket, sum(delta)
+                FROM moved
+                GROUP BY dimension, bucket
+                ON CONFLICT (dimension, bucket)
+                DO UPDATE SET count = stats_counters.count + excluded.count
+            )
+            SELECT count(*) INTO folded FROM moved;
+            RETURN folded;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+
+
+def downgrade():
+    op.execute("""
+        SELECT stats_fold();
+        DROP FUNCTION stats_fold();
+        DROP TRIGGER movies_stats_delete ON movies;
+        DROP TRIGGER movies_stats_update ON movies;
+        DROP TRIGGER movies_stats_insert ON movies;
+        DROP TRIGGER actors_stats_delete ON actors;
+        DROP TRIGGER actors_stats_update ON actors;
+        DROP TRIGGER actors_stats_insert ON actors;
+        DROP FUNCTION movies_stats();
+        DROP FUNCTION actors_stats();
+    """ + ROW_TRIGGERS)
+    op.drop_index('ix_stats_deltas_dimension_bucket',
+                  table_name='stats_deltas')
+    op.drop_table('stats_deltas')
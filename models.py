@@ -1,24 +1,299 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from dateutil import parser as date_parser
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from cache import invalidate
+from routing import RoutingSQLAlchemy
+
+# Creating an unconfigured Flask-SQLAlchemy instance, routing the reads of
+# GET requests to the read replicas when there are any
+db = RoutingSQLAlchemy()
+
+# rows per multi-row INSERT statement of bulk_insert
+BULK_INSERT_BATCH_SIZE = 1000
+
+
+class TooManyRows(Exception):
+    """
+    Raised, after rolling back, when a bulk statement matches more rows
+    than it is allowed to change; count is the number of rows seen
+    before giving up, max_rows + 1
+    """
+
+    def __init__(self, count):
+        self.count = count
+
+
+# Field coercion
+
+def _text(value):
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError('must be a non-empty string')
+    return value
+
+
+def _age(value):
+    if isinstance(value, bool):
+        raise ValueError('must be an integer')
+    try:
+        age = int(value)
+    except (TypeError, ValueError):
+        raise ValueError('must be an integer')
+    if age < 0:
+        raise ValueError('must not be negative')
+    return age
+
+
+def _datetime(value):
+    if isinstance(value, str):
+        try:
+            value = date_parser.parse(value)
+        except (ValueError, OverflowError):
+            raise ValueError('must be a date')
+    if not isinstance(value, datetime):
+        raise ValueError('must be a date')
+    if value.tzinfo is not None:
+        # columns hold naive UTC timestamps
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def coerce_fields(data, coercers, partial=False):
+    """
+    Validates and coerces the fields of a request body
+    :param coercers: dict of field name to coercion function
+    :param partial: only coerce the fields present in data
+    :return dict of column values
+    :raises ValueError describing the first invalid field
+    """
+    if not isinstance(data, dict):
+        raise ValueError('expected an object')
+    values = {}
+    for field, coerce in coercers.items():
+        if data.get(field) is None:
+            if not partial:
+                raise ValueError(f'{field} is required')
+            continue
+        try:
+            values[field] = coerce(data[field])
+        except ValueError as error:
+            raise ValueError(f'{field} {error}')
+    return values
+
+
+class BulkMixin(object):
+    """
+    Set-based writes shared by the models
+    """
+
+    @classmethod
+    def validate(cls, data, partial=False):
+        """validates and coerces a request body into column values
+        Example
+          `values = Actor.validate({'name': 'actor1', 'age': '30', ...})`
+        """
+        return coerce_fields(data, cls.field_coercers, partial)
+
+    @classmethod
+    def bulk_insert(cls, rows):
+        """inserts validated rows with multi-row INSERT ... RETURNING
+        statements in one transaction
+        Example
+          `ids = Actor.bulk_insert([{'name': 'a', 'age': 30, 'gender': 'F'}])`
+        :return ids of the new rows, in the order of rows
+        """
+        table = cls.__table__
+        ids = []
+        try:
+            for start in range(0, len(rows), BULK_INSERT_BATCH_SIZE):
+                batch = rows[start:start + BULK_INSERT_BATCH_SIZE]
+                result = db.session.execute(
+                    table.insert().values(batch).returning(table.c.id))
+                ids.extend(row[0] for row in result)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        invalidate(cls.__tablename__)
+        return ids
+
+    @classmethod
+    def update_by_id(cls, row_id, values):
+        """updates the given columns of one row with a single
+        UPDATE ... RETURNING statement, without loading it first
+        Example
+          `actor = Actor.update_by_id(actor_id, {'age': 25})`
+        :return dict of format() fields, or None if the row does not exist
+        """
+        table = cls.__table__
+        try:
+            row = db.session.execute(
+                table.update().where(table.c.id == row_id).values(values)
+                .returning(*[table.c[field] for field in cls.format_fields])
+            ).first()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if row is None:
+            return None
+        invalidate(cls.__tablename__, row_id)
+        return dict(zip(cls.format_fields, row))
+
+    @classmethod
+    def _bulk_execute(cls, statement, condition, max_rows):
+        """
+        Locks the ids matching condition, at most max_rows + 1 of them,
+        and runs statement, a set-based statement returning the ids of
+        its rows, on those ids only, so a request over max_rows is
+        refused before any row is changed
+        """
+        table = cls.__table__
+        try:
+            ids = [row[0] for row in db.session.execute(
+                select(table.c.id).where(condition).order_by(table.c.id)
+                .limit(max_rows + 1).with_for_update())]
+            if len(ids) > max_rows:
+                raise TooManyRows(len(ids))
+            if ids:
+                ids = [row[0] for row in db.session.execute(
+                    statement.where(table.c.id.in_(ids)))]
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        invalidate(cls.__tablename__)
+        for row_id in ids:
+            invalidate(cls.__tablename__, row_id)
+        return ids
+
+    @classmethod
+    def bulk_update(cls, condition, values, max_rows):
+        """updates the rows matching condition with one UPDATE statement,
+        refused if it matches more than max_rows rows
+        Example
+          `Actor.bulk_update(Actor.id.in_(ids), {'age': 30}, 1000)`
+        :return ids of the updated rows
+        :raises TooManyRows
+        """
+        table = cls.__table__
+        return cls._bulk_execute(
+            table.update().values(values).returning(table.c.id),
+            condition, max_rows)
+
+    @classmethod
+    def bulk_delete(cls, condition, max_rows):
+        """deletes the rows matching condition with one DELETE statement,
+        refused if it matches more than max_rows rows
+        Example
+          `Movie.bulk_delete(Movie.id.in_(ids), 1000)`
+        :return ids of the deleted rows
+        :raises TooManyRows
+        """
+        table = cls.__table__
+        return cls._bulk_execute(
+            table.delete().returning(table.c.id), condition, max_rows)
+
+    @classmethod
+    def delete_by_id(cls, row_id):
+        """deletes one row with a single DELETE ... RETURNING statement
+        Example
+          `if not Movie.delete_by_id(movie_id): abort(404)`
+        :return True if the row existed
+        """
+        table = cls.__table__
+        try:
+            row = db.session.execute(
+                table.delete().where(table.c.id == row_id)
+                .returning(table.c.id)
+            ).first()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if row is None:
+            return False
+        invalidate(cls.__tablename__, row_id)
+        return True
 
-# Creating an unconfigured Flask-SQLAlchemy instance
-db = SQLAlchemy()
 
 # Models.
 
+# Casting of actors in movies
+castings = db.Table(
+    'castings',
+    db.Column('movie_id', db.Integer,
+              db.ForeignKey('movies.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Column('actor_id', db.Integer,
+              db.ForeignKey('actors.id', ondelete='CASCADE'),
+              primary_key=True),
+    db.Index('ix_castings_actor_id', 'actor_id', 'movie_id')
+)
+
+# Aggregate counts by dimension and bucket, maintained by the triggers
+# on actors and movies created in the migrations
+stats_counters = db.Table(
+    'stats_counters',
+    db.Column('dimension', db.String, primary_key=True),
+    db.Column('bucket', db.String, primary_key=True),
+    db.Column('count', db.BigInteger, nullable=False)
+)
+
+# Changes to stats_counters journaled by the statement triggers, folded
+# into it by fold_stats; the counts are the sums of both tables
+stats_deltas = db.Table(
+    'stats_deltas',
+    db.Column('dimension', db.String, nullable=False),
+    db.Column('bucket', db.String, nullable=False),
+    db.Column('delta', db.BigInteger, nullable=False),
+    db.Index('ix_stats_deltas_dimension_bucket', 'dimension', 'bucket')
+)
+
+
+def fold_stats():
+    """
+    Moves the deltas journaled by the triggers into stats_counters, in a
+    transaction of its own, unless another session is folding them; a
+    no-op on databases other than PostgreSQL
+    Example
+      `fold_stats()`
+    :return number of deltas folded
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return 0
+    try:
+        count = db.session.execute(db.text('SELECT stats_fold()')).scalar()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return count
+
 
-class Actor(db.Model):
+class Actor(BulkMixin, db.Model):
     """
     Actor Model to create actor table in postgres
     Each Actor must have a name, age, gender
     """
     __tablename__ = "actors"
+    __table_args__ = (
+        db.Index('ix_actors_name_trgm', 'name', postgresql_using='gin',
+                 postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
+    # columns returned by format(), in response order
+    format_fields = ('id', 'name', 'age', 'gender')
+    field_coercers = {'name': _text, 'age': _age, 'gender': _text}
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
-    age = db.Column(db.Integer, nullable=False)
+    age = db.Column(db.Integer, nullable=False, index=True)
     gender = db.Column(db.String, nullable=False)
+    # validator for conditional GETs, bumped on every write
+    updated_at = db.Column(db.DateTime, nullable=False, index=True,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def get_actorname(self):
         """returns actor name
@@ -35,6 +310,7 @@ class Actor(db.Model):
         """
         db.session.add(self)
         db.session.commit()
+        invalidate(self.__tablename__, self.id)
 
     def delete(self):
         """deletes an actor record
@@ -45,6 +321,7 @@ class Actor(db.Model):
         """
         db.session.delete(self)
         db.session.commit()
+        invalidate(self.__tablename__, self.id)
 
     def update(self):
         """ updates columns in a row
@@ -55,6 +332,7 @@ class Actor(db.Model):
           `actor.update()`
         """
         db.session.commit()
+        invalidate(self.__tablename__, self.id)
 
     def format(self):
         """returns actor information in formated response
@@ -67,16 +345,31 @@ class Actor(db.Model):
         }
 
 
-class Movie(db.Model):
+class Movie(BulkMixin, db.Model):
     """
     Movie Model to create movies table in postgres
     Each Movie must have a title and release date
     """
     __tablename__ = "movies"
+    __table_args__ = (
+        db.Index('ix_movies_title_trgm', 'title', postgresql_using='gin',
+                 postgresql_ops={'title': 'gin_trgm_ops'}),
+    )
+    # columns returned by format(), in response order
+    format_fields = ('id', 'title', 'release_date')
+    field_coercers = {'title': _text, 'release_date': _datetime}
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False)
-    release_date = db.Column(db.DateTime(), default=datetime.utcnow)
+    release_date = db.Column(db.DateTime(), default=datetime.utcnow,
+                             index=True)
+    # validator for conditional GETs, bumped on every write
+    updated_at = db.Column(db.DateTime, nullable=False, index=True,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
+    actors = db.relationship(
+        'Actor', secondary=castings,
+        backref=db.backref('movies', passive_deletes=True),
+        passive_deletes=True)
 
     def get_title(self):
         """returns movie title
@@ -93,6 +386,7 @@ class Movie(db.Model):
         """
         db.session.add(self)
         db.session.commit()
+        invalidate(self.__tablename__, self.id)
 
     def delete(self):
         """deletes a movie record
@@ -103,6 +397,7 @@ class Movie(db.Model):
         """
         db.session.delete(self)
         db.session.commit()
+        invalidate(self.__tablename__, self.id)
 
     def update(self):
         """ updates columns in a row
@@ -113,6 +408,7 @@ class Movie(db.Model):
           `movie.update()`
         """
         db.session.commit()
+        invalidate(self.__tablename__, self.id)
 
     def format(self):
         """returns movie information in formated response
@@ -122,3 +418,148 @@ class Movie(db.Model):
             'title': self.title,
             'release_date': self.release_date
         }
+
+    @classmethod
+    def _touch_casting(cls, movie_id, actor_ids):
+        """bumps updated_at of a movie and actors whose casting changed"""
+        now = datetime.utcnow()
+        db.session.execute(cls.__table__.update().where(
+            cls.id == movie_id).values(updated_at=now))
+        db.session.execute(Actor.__table__.update().where(
+            Actor.id.in_(actor_ids)).values(updated_at=now))
+
+    @classmethod
+    def _invalidate_casting(cls, movie_id, actor_ids):
+        invalidate(cls.__tablename__, movie_id)
+        invalidate(Actor.__tablename__)
+        for actor_id in actor_ids:
+            invalidate(Actor.__tablename__, actor_id)
+
+    @classmethod
+    def assign_actors(cls, movie_id, actor_ids):
+        """casts actors in a movie with one INSERT statement, skipping
+        actors that are already cast
+        Example
+          `Movie.assign_actors(movie_id, [1, 2, 3])`
+        :return number of new castings
+        """
+        statement = pg_insert(castings).values([
+            {'movie_id': movie_id, 'actor_id': actor_id}
+            for actor_id in actor_ids
+        ]).on_conflict_do_nothing()
+        try:
+            count = db.session.execute(statement).rowcount
+            cls._touch_casting(movie_id, actor_ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls._invalidate_casting(movie_id, actor_ids)
+        return count
+
+    @classmethod
+    def unassign_actors(cls, movie_id, actor_ids):
+        """removes actors from the cast of a movie with one DELETE statement
+        Example
+          `Movie.unassign_actors(movie_id, [1, 2])`
+        :return number of removed castings
+        """
+        statement = castings.delete().where(
+            (castings.c.movie_id == movie_id) &
+            castings.c.actor_id.in_(actor_ids))
+        try:
+            count = db.session.execute(statement).rowcount
+            cls._touch_casting(movie_id, actor_ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls._invalidate_casting(movie_id, actor_ids)
+        return count
+
+
+class IdempotencyKey(db.Model):
+    """
+    Outcome of a request sent with an Idempotency-Key header, replayed
+    to the retries of the same request until the key expires. The
+    primary key serializes concurrent duplicates: only one of them can
+    claim the key.
+    """
+    __tablename__ = "idempotency_keys"
+
+    # jwt subject the key belongs to
+    principal = db.Column(db.String, primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    # null while the first request is still running
+    status = db.Column(db.Integer)
+    response = db.Column(db.LargeBinary)
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    @classmethod
+    def _match(cls, principal, key):
+        return (cls.principal == principal) & (cls.key == key)
+
+    @classmethod
+    def claim(cls, principal, key, request_hash):
+        """inserts the key in a transaction of its own, so no lock is held
+        while the request runs
+        Example
+          `claimed = IdempotencyKey.claim(payload['sub'], key, digest)`
+        :return True if the key was claimed, False if it already exists
+        """
+        try:
+            db.session.execute(cls.__table__.insert().values(
+                principal=principal, key=key, request_hash=request_hash,
+                created_at=datetime.utcnow()))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        return True
+
+    @classmethod
+    def lookup(cls, principal, key):
+        """returns the row of the key, or None"""
+        return db.session.query(cls.__table__).filter(
+            cls._match(principal, key)).first()
+
+    @classmethod
+    def store(cls, principal, key, status, response):
+        """records the response of the request that claimed the key"""
+        db.session.execute(cls.__table__.update().where(
+            cls._match(principal, key)).values(
+                status=status, response=response))
+        db.session.commit()
+
+    @classmethod
+    def release(cls, principal, key, created_at=None):
+        """deletes the key so the request can run again, only if it was
+        still created at created_at when given
+        :return True if the key was deleted
+        """
+        db.session.rollback()
+        condition = cls._match(principal, key)
+        if created_at is not None:
+            condition &= cls.created_at == created_at
+        count = db.session.execute(
+            cls.__table__.delete().where(condition)).rowcount
+        db.session.commit()
+        return count > 0
+
+    @classmethod
+    def sweep(cls, ttl, inflight_timeout):
+        """deletes the keys older than ttl seconds, and those of requests
+        still running after inflight_timeout seconds
+        Example
+          `IdempotencyKey.sweep(86400, 60)`
+        :return number of deleted keys
+        """
+        now = datetime.utcnow()
+        count = db.session.execute(cls.__table__.delete().where(
+            (cls.created_at < now - timedelta(seconds=ttl)) |
+            (cls.status.is_(None) &
+             (cls.created_at < now - timedelta(seconds=inflight_timeout)))
+        )).rowcount
+        db.session.commit()
+        return count
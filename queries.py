@@ -0,0 +1,514 @@
+import base64
+import binascii
+import json
+import time
+from flask import current_app, request
+from sqlalchemy import (
+    Integer, String, and_, any_, extract, func, literal, select)
+from sqlalchemy.dialects.postgresql import ARRAY
+from cache import MemoryBackend
+from models import (
+    db, castings, fold_stats, stats_counters, stats_deltas, Actor, Movie)
+
+
+# Pagination
+def encode_cursor(last_id):
+    """returns opaque cursor pointing after the row with id last_id"""
+    raw = json.dumps({'id': last_id}, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by encode_cursor
+    :return id of the last row of the previous page
+    :raises ValueError if the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        last_id = json.loads(raw.decode('utf-8'))['id']
+    except (binascii.Error, UnicodeDecodeError, ValueError, KeyError,
+            TypeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError('invalid cursor')
+    return last_id
+
+
+def page_args(args, default_limit, max_limit):
+    """
+    Reads the `limit` and `cursor` query parameters
+    :return (limit, last id or None)
+    :raises ValueError on a malformed limit or cursor
+    """
+    limit = int(args.get('limit', default_limit))
+    if limit < 1:
+        raise ValueError('invalid limit')
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    return min(limit, max_limit), after
+
+
+def seek(query, key, limit, after=None):
+    """
+    Orders a Query or select() by key and seeks past `after` with an
+    index range scan (`key > after`) instead of an OFFSET, fetching one
+    row more than limit to tell whether there is a next page
+    """
+    if after is not None:
+        query = query.filter(key > after)
+    return query.order_by(key).limit(limit + 1)
+
+
+def page_rows(rows, limit):
+    """
+    Cuts the rows fetched by seek to one page
+    :return (rows, cursor of the next page or None on the last page)
+    """
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    return rows, next_cursor
+
+
+def keyset_page(query, key, limit, after=None):
+    """
+    Fetches one page ordered by key, seeking past `after`
+    Example
+      `rows, next_cursor = keyset_page(Actor.query, Actor.id, 50)`
+    :return (rows, cursor of the next page or None on the last page)
+    """
+    return page_rows(seek(query, key, limit, after).all(), limit)
+
+
+# Column-only reads
+def field_args(args, model):
+    """
+    Reads the `fields` query parameter, a comma separated list of the
+    format() fields of model
+    :return tuple of the requested fields in format() order
+    :raises ValueError on an unknown field
+    """
+    fields = args.get('fields')
+    if fields is None:
+        return model.format_fields
+    requested = set(field.strip() for field in fields.split(','))
+    requested.discard('')
+    if not requested or not requested <= set(model.format_fields):
+        raise ValueError('invalid fields')
+    return tuple(
+        field for field in model.format_fields if field in requested)
+
+
+def select_columns(model, fields=None):
+    """
+    Read-only query of plain rows holding only the given columns, which
+    skips building ORM instances and identity map bookkeeping. The id is
+    appended when it is not requested, so rows can still be paginated;
+    rows_to_dicts leaves it out again.
+    Example
+      `query = select_columns(Actor, ('name', 'age'))`
+    :return Query of rows
+    """
+    return db.session.query(*column_list(model, fields))
+
+
+def column_list(model, fields=None):
+    """returns the columns of fields, with the id appended when missing"""
+    fields = fields or model.format_fields
+    if 'id' not in fields:
+        fields = fields + ('id',)
+    return [getattr(model, field) for field in fields]
+
+
+def rows_to_dicts(rows, fields):
+    """serializes rows of select_columns to dicts of the given fields"""
+    return [dict(zip(fields, row)) for row in rows]
+
+
+# Related rows
+# include argument of each model: (related model, own column, related
+# column) of the castings table
+INCLUDES = {
+    Movie: {'actors': (Actor, castings.c.movie_id, castings.c.actor_id)},
+    Actor: {'movies': (Movie, castings.c.actor_id, castings.c.movie_id)},
+}
+
+
+def include_arg(args, model):
+    """
+    Reads the `include` query parameter, e.g. `actors` for movies
+    :return name of the relation to include, or None
+    :raises ValueError on an unknown relation
+    """
+    include = args.get('include')
+    if include is None:
+        return None
+    if include not in INCLUDES[model]:
+        raise ValueError('invalid include')
+    return include
+
+
+def related_rows(model, include, ids):
+    """
+    Loads the related rows of every id in ids with one joined query over
+    castings, so the number of queries does not grow with the page size
+    :return dict of id to list of related dicts
+    """
+    related, own, other = INCLUDES[model][include]
+    fields = related.format_fields
+    query = select_columns(related, fields).add_columns(own).join(
+        castings, other == related.id).filter(own.in_(ids)).order_by(
+        related.id)
+    grouped = {row_id: [] for row_id in ids}
+    for row in query:
+        grouped[row[-1]].append(dict(zip(fields, row)))
+    return grouped
+
+
+def attach_related(model, include, ids, items):
+    """
+    Adds the related rows of include to each dict of items
+    Example
+      `attach_related(Movie, 'actors', [row.id for row in rows], movies)`
+    :param ids: ids of items, in the same order
+    """
+    related = related_rows(model, include, ids)
+    for row_id, item in zip(ids, items):
+        item[include] = related[row_id]
+
+
+# Lookups by id
+def ids_arg(args, max_ids):
+    """
+    Reads the `ids` query parameter, a comma separated list of ids
+    :return list of distinct ids in request order
+    :raises ValueError on a malformed or too long list, duplicates
+    included, checked before any value is parsed
+    """
+    values = args.get('ids', '').split(',')
+    if len(values) > max_ids:
+        raise ValueError('too many ids')
+    return list(dict.fromkeys(int(value) for value in values))
+
+
+def id_in(model, ids):
+    """
+    Condition matching the rows of ids: `id = ANY(:ids)` with a single
+    array parameter on PostgreSQL, `id IN (...)` on other databases
+    """
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return model.id == any_(literal(ids, ARRAY(Integer)))
+    return model.id.in_(ids)
+
+
+def rows_by_ids(model, fields, ids):
+    """
+    Fetches the requested fields of the rows of ids in one query
+    :return (dicts in the order of ids, ids that do not exist)
+    """
+    rows = {
+        row.id: dict(zip(fields, row))
+        for row in select_columns(model, fields).filter(id_in(model, ids))
+    }
+    return ([rows[row_id] for row_id in ids if row_id in rows],
+            [row_id for row_id in ids if row_id not in rows])
+
+
+# Filters
+def _escape_like(value):
+    """escapes the LIKE wildcards of a search term"""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_')
+
+
+# filter suffix: (comparison, only valid on text columns)
+FILTER_OPERATORS = {
+    '_min': (lambda column, value: column >= value, False),
+    '_max': (lambda column, value: column <= value, False),
+    # both are served by the trigram indexes on name and title
+    '_prefix': (lambda column, value: column.ilike(
+        _escape_like(value) + '%', escape='\\'), True),
+    '_contains': (lambda column, value: column.ilike(
+        '%' + _escape_like(value) + '%', escape='\\'), True),
+}
+
+# query parameters of the list endpoints that are not filters
+LIST_ARGS = (
+    'limit', 'cursor', 'fields', 'include', 'ids', 'format', 'count')
+
+
+def filter_args(args):
+    """returns the filter parameters of a list request"""
+    return {name: value for name, value in args.items()
+            if name not in LIST_ARGS}
+
+
+def compile_filters(model, params):
+    """
+    Compiles a constrained filter into one SQL condition. Keys are the
+    writable fields of model for equality, a field with a `_min` /
+    `_max` suffix for an inclusive range, or a text field with a
+    `_prefix` / `_contains` suffix for a case-insensitive search, e.g.
+    {'gender': 'F', 'age_min': 25, 'age_max': 30, 'name_prefix': 'jo'}
+    :return condition, or None when params is empty
+    :raises ValueError on an unknown field or invalid value
+    """
+    conditions = []
+    for name, value in params.items():
+        field, compare, text_only = name, \
+            lambda column, value: column == value, False
+        for suffix, (operator, operator_text_only) in \
+                FILTER_OPERATORS.items():
+            if name.endswith(suffix):
+                field = name[:-len(suffix)]
+                compare, text_only = operator, operator_text_only
+        coerce = model.field_coercers.get(field)
+        if coerce is None:
+            raise ValueError(f'unknown filter {name}')
+        column = getattr(model, field)
+        if text_only and not isinstance(column.type, String):
+            raise ValueError(f'unknown filter {name}')
+        try:
+            value = coerce(value)
+        except ValueError as error:
+            raise ValueError(f'{name} {error}')
+        conditions.append(compare(column, value))
+    if not conditions:
+        return None
+    return and_(*conditions)
+
+
+# Total counts
+COUNT_MODES = ('exact', 'estimated', 'cached', 'none')
+
+# exact counts memoized by count_rows in 'cached' mode
+_count_cache = MemoryBackend(max_entries=256)
+
+
+def count_arg(args, default):
+    """
+    Reads the `count` query parameter
+    :return one of COUNT_MODES
+    :raises ValueError on an unknown mode
+    """
+    mode = args.get('count', default)
+    if mode not in COUNT_MODES:
+        raise ValueError('invalid count')
+    return mode
+
+
+def _count_query(model, condition):
+    query = db.session.query(func.count(model.id))
+    if condition is not None:
+        query = query.filter(condition)
+    return query
+
+
+def _estimated_count(model, condition):
+    """
+    Planner estimate of the number of rows: pg_class.reltuples for the
+    whole table, the row estimate of EXPLAIN for a filtered query
+    :return estimate, or None where no estimate is available
+    """
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        return None
+    if condition is None:
+        estimate = db.session.execute(
+            db.text('SELECT reltuples FROM pg_class '
+                    'WHERE oid = CAST(:table AS regclass)'),
+            {'table': model.__tablename__}).scalar()
+        # reltuples is negative until the table was first analyzed
+        return int(estimate) if estimate is not None and \
+            estimate >= 0 else None
+    compiled = db.session.query(model.id).filter(condition).statement \
+        .compile(dialect=connection.dialect)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + str(compiled),
+                       compiled.params)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def count_rows(model, condition, mode, ttl=60):
+    """
+    Counts the rows of model matching condition, exactly with COUNT(*),
+    from the planner statistics ('estimated'), or with an exact count
+    memoized for ttl seconds ('cached')
+    :return count, or None for mode 'none', and for 'estimated' where the
+    database has no estimate rather than falling back to a full count
+    """
+    if mode == 'none':
+        return None
+    if mode == 'estimated':
+        return _estimated_count(model, condition)
+    query = _count_query(model, condition)
+    if mode == 'cached':
+        compiled = query.statement.compile()
+        key = repr((str(compiled), sorted(compiled.params.items())))
+        count = _count_cache.get(key)
+        if count is None:
+            count = query.scalar()
+            _count_cache.set(key, count, ttl)
+        return count
+    return query.scalar()
+
+
+# Validators for conditional requests
+def counter_total(dimension, bucket):
+    """
+    Scalar subquery of a counter maintained by the triggers: its folded
+    total plus its deltas not folded yet, a primary key lookup and an
+    index range scan over the few deltas since the last fold
+    """
+    folded = select(stats_counters.c.count).where(and_(
+        stats_counters.c.dimension == dimension,
+        stats_counters.c.bucket == bucket)).scalar_subquery()
+    pending = select(func.coalesce(func.sum(stats_deltas.c.delta), 0)).where(
+        and_(stats_deltas.c.dimension == dimension,
+             stats_deltas.c.bucket == bucket)).scalar_subquery()
+    return func.coalesce(folded, 0) + pending
+
+
+def table_version(model):
+    """
+    Cheap validator of a whole table, changed by any insert, update or
+    delete without reading the rows themselves. It has no date: a delete
+    leaves the latest updated_at as it is, so a Last-Modified taken from
+    it would answer If-Modified-Since with a stale 304.
+    :return (seed, None)
+    """
+    version = db.session.query(*table_version_columns(
+        model, db.session.get_bind().dialect.name)).one()
+    return tuple(version), None
+
+
+def table_version_columns(model, dialect='postgresql'):
+    """
+    Returns the columns making up the validator of table_version. On
+    PostgreSQL that is the number of write statements on the table,
+    counted by its trigger, which costs the same whatever the size of the
+    table; elsewhere the row count, highest id and latest updated_at,
+    which need a scan.
+    """
+    if dialect == 'postgresql':
+        return (counter_total('table_writes', model.__tablename__),)
+    return (func.count(model.id), func.max(model.id),
+            func.max(model.updated_at))
+
+
+def related_version(model, args):
+    """
+    Validator of the table whose rows `include` embeds, which the
+    validator of model alone misses: renaming a movie changes
+    `/actors?include=movies` without writing to actors
+    :return table_version of the related model, or None without include
+    """
+    related = INCLUDES[model].get(args.get('include'))
+    if related is None:
+        return None
+    return table_version(related[0])
+
+
+def row_version(model, row_id):
+    """
+    Validator of a single row
+    :return ((id, updated_at), updated_at), or None if the row is missing
+    """
+    updated_at = db.session.query(model.updated_at).filter(
+        model.id == row_id).scalar()
+    if updated_at is None:
+        return None
+    return (row_id, updated_at), updated_at
+
+
+# Statistics
+STATS_DIMENSIONS = (
+    'actors_by_gender', 'actors_by_age', 'movies_by_release_year')
+
+
+def age_bucket(age):
+    """returns the ten year bucket of age, e.g. '20-29'"""
+    start = age // 10 * 10
+    return f'{start}-{start + 9}'
+
+
+def stats_summary():
+    """
+    Reads the counters maintained incrementally by the database triggers,
+    the folded totals plus the deltas not folded yet, one row per group
+    whatever the size of the tables
+    :return dict of dimension to dict of bucket to count
+    """
+    stats = {dimension: {} for dimension in STATS_DIMENSIONS}
+    totals = db.session.query(
+        stats_counters.c.dimension.label('dimension'),
+        stats_counters.c.bucket.label('bucket'),
+        stats_counters.c.count.label('count')).union_all(
+        db.session.query(
+            stats_deltas.c.dimension, stats_deltas.c.bucket,
+            stats_deltas.c.delta)).subquery()
+    rows = db.session.query(
+        totals.c.dimension, totals.c.bucket, func.sum(totals.c.count)
+    ).filter(totals.c.dimension.in_(STATS_DIMENSIONS)).group_by(
+        totals.c.dimension, totals.c.bucket).having(
+        func.sum(totals.c.count) > 0)
+    for dimension, bucket, count in rows:
+        stats[dimension][bucket] = int(count)
+    return stats
+
+
+# monotonic time of the last fold of the stats deltas by this process
+_last_fold = 0.0
+
+
+def fold_stats_after_write(response):
+    """
+    after_request hook folding the stats deltas after a write, at most
+    every STATS_FOLD_INTERVAL seconds per process, so the deltas summed
+    by stats_summary stay few
+    """
+    global _last_fold
+    if request.method in ('GET', 'HEAD', 'OPTIONS'):
+        return response
+    now = time.monotonic()
+    if now - _last_fold < current_app.config['STATS_FOLD_INTERVAL']:
+        return response
+    _last_fold = now
+    try:
+        fold_stats()
+    except Exception:
+        # the deltas are folded by the next write or manage.py fold_stats
+        pass
+    return response
+
+
+def stats_live():
+    """
+    Computes the same counts as stats_summary with GROUP BY queries over
+    the tables
+    :return dict of dimension to dict of bucket to count
+    """
+    stats = {dimension: {} for dimension in STATS_DIMENSIONS}
+    for gender, count in db.session.query(
+            Actor.gender, func.count()).group_by(Actor.gender):
+        stats['actors_by_gender'][gender] = count
+    for age, count in db.session.query(
+            Actor.age, func.count()).group_by(Actor.age):
+        bucket = age_bucket(age)
+        stats['actors_by_age'][bucket] = \
+            stats['actors_by_age'].get(bucket, 0) + count
+    year = extract('year', Movie.release_date)
+    for release_year, count in db.session.query(
+            year, func.count()).group_by(year):
+        bucket = 'unknown' if release_year is None else \
+            str(int(release_year))
+        stats['movies_by_release_year'][bucket] = count
+    return stats
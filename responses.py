@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+from datetime import date
+from functools import wraps
+from itertools import islice
+from flask import Response, make_response, request, stream_with_context
+from queries import related_version, row_version, table_version
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 'orjson' when it is installed, 'json' to force the standard library
+JSON_BACKEND = os.environ.get('JSON_BACKEND') or \
+    ('orjson' if orjson is not None else 'json')
+
+
+# JSON encoding
+def _encode_default(obj):
+    """encodes the types the json module does not know about"""
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, default=_encode_default, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=_encode_default)
+
+
+JSON_ENCODERS = {
+    'json': _stdlib_dumps,
+    'orjson': _orjson_dumps,
+}
+
+
+def dumps(obj):
+    """
+    Compact JSON encoding of obj with datetimes in ISO-8601
+    :return utf-8 encoded bytes
+    """
+    return JSON_ENCODERS[JSON_BACKEND](obj)
+
+
+def json_response(obj, status=200):
+    """
+    Response with obj encoded by the configured JSON backend, used
+    instead of jsonify
+    Example
+      `return json_response({'success': True}, 200)`
+    """
+    return Response(dumps(obj), status=status, mimetype='application/json')
+
+
+# Streaming responses
+def _batches(items, batch_size):
+    """yields lists of at most batch_size items"""
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def stream_json(key, items, batch_size=1000):
+    """
+    Streams items as `{"success": true, "<key>": [...]}`, one chunk per
+    batch, so the first bytes go out before the query has finished
+    Example
+      `return stream_json('actors', (row.format() for row in query))`
+    """
+    def generate():
+        yield b'{"success":true,"%s":[' % key.encode('utf-8')
+        separator = b''
+        for batch in _batches(items, batch_size):
+            yield separator + b','.join(dumps(item) for item in batch)
+            separator = b','
+        yield b']}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def stream_ndjson(items, batch_size=1000):
+    """
+    Streams items as newline delimited JSON, one chunk per batch
+    Example
+      `return stream_ndjson(row.format() for row in query)`
+    """
+    def generate():
+        for batch in _batches(items, batch_size):
+            yield b''.join(dumps(item) + b'\n' for item in batch)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+# Conditional requests
+def make_etag(seed, full_path):
+    """returns the ETag of a validator seed for a path with its query"""
+    return hashlib.sha1(
+        repr((seed, full_path)).encode('utf-8')).hexdigest()
+
+
+def not_modified(etag, last_modified, if_none_match, since):
+    """
+    True if the request validators match the current representation,
+    If-None-Match takes precedence over If-Modified-Since
+    :param if_none_match: parsed ETags of the request
+    :param since: parsed If-Modified-Since date, or None
+    """
+    if if_none_match:
+        return if_none_match.contains_weak(etag)
+    if since is None or last_modified is None:
+        return False
+    if since.tzinfo is not None:
+        since = since.replace(tzinfo=None) - since.utcoffset()
+    return last_modified.replace(microsecond=0) <= since
+
+
+def _not_modified(etag, last_modified):
+    return not_modified(etag, last_modified, request.if_none_match,
+                        request.if_modified_since)
+
+
+def conditional(model):
+    """
+    Decorator answering GET requests with 304 Not Modified, before the
+    view runs its query, when the client's ETag or Last-Modified is still
+    current. The validator covers the whole table for collection routes
+    and the row for item routes (routes taking the row id), plus the
+    related table with `include`. Only item routes without `include` have
+    a Last-Modified date, the other validators are not moved by deletes.
+    Example
+      `@conditional(Actor)`
+    """
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if kwargs:
+                version = row_version(model, *kwargs.values())
+            else:
+                version = table_version(model)
+            if version is None:
+                return f(*args, **kwargs)
+            seed, last_modified = version
+            related = related_version(model, request.args)
+            if related is not None:
+                seed = (seed, related[0])
+                last_modified = None
+            etag = make_etag(seed, request.full_path)
+            if _not_modified(etag, last_modified):
+                response = Response(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+    return conditional_decorator
@@ -0,0 +1,208 @@
+import itertools
+import os
+import threading
+import time
+from flask import _request_ctx_stack, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, orm, text
+from cache import MemoryBackend, RedisBackend, response_cache
+from config import engine_options
+
+# methods whose queries may be served by a replica
+READ_METHODS = ('GET', 'HEAD')
+
+
+def pin_store(url):
+    """
+    Store of the read-your-writes pins, apart from the cached responses so
+    their churn never evicts a pin: Redis when the response cache is on
+    Redis, shared by the workers, an in-process store otherwise
+    """
+    if url and url.startswith('redis'):
+        return RedisBackend.from_url(url)
+    return MemoryBackend(100000)
+
+
+class Replica(object):
+    """engine of a read replica and the result of its last health check"""
+
+    def __init__(self, url, connect_timeout=2):
+        self.url = url
+        options = engine_options(url)
+        if options:
+            # a replica that is down must fail its check quickly
+            options['connect_args'] = dict(
+                options['connect_args'], connect_timeout=connect_timeout)
+        self.engine = create_engine(url, **options)
+        # unknown until the first check, reads go to the primary until then
+        self.healthy = False
+        self.checked_at = 0.0
+
+    def check(self):
+        """runs SELECT 1 on the replica, returns whether it succeeded"""
+        try:
+            with self.engine.connect() as connection:
+                connection.scalar(text('SELECT 1'))
+            self.healthy = True
+        except Exception:
+            self.healthy = False
+        self.checked_at = time.monotonic()
+        return self.healthy
+
+
+class ReplicaSet(object):
+    """
+    Read replicas picked round-robin, skipping those that failed their
+    last health check, and the read-your-writes pins of the clients that
+    wrote recently. Health checks run in a background thread of each
+    process, never on the path of a request. Pins, and the marks of the
+    tables written recently, are kept in a store of their own, shared by
+    the workers when it is Redis.
+    """
+
+    def __init__(self, urls=(), pin_seconds=10, health_interval=10,
+                 pins=None, prefix='casting', connect_timeout=2):
+        self.replicas = [Replica(url, connect_timeout) for url in urls]
+        self.pin_seconds = pin_seconds
+        self.health_interval = health_interval
+        self.pins = pins if pins is not None else pin_store(None)
+        self.prefix = prefix
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._checker_pid = None
+
+    def check_all(self):
+        """checks every replica, returns how many are healthy"""
+        return sum(replica.check() for replica in self.replicas)
+
+    def _check_forever(self):
+        while True:
+            self.check_all()
+            time.sleep(self.health_interval)
+
+    def _start_checks(self):
+        # one checker per process: a thread started in the gunicorn master
+        # by preload_app does not survive the fork into the workers
+        with self._lock:
+            if self._checker_pid == os.getpid():
+                return
+            self._checker_pid = os.getpid()
+        threading.Thread(target=self._check_forever, name='replica-checks',
+                         daemon=True).start()
+
+    def choose(self):
+        """
+        Picks the next replica that passed its last health check
+        :return engine, or None when no replica is healthy
+        """
+        self._start_checks()
+        for _ in range(len(self.replicas)):
+            with self._lock:
+                replica = self.replicas[next(self._next) % len(self.replicas)]
+            if replica.healthy:
+                return replica.engine
+        return None
+
+    def _pin_key(self, user):
+        return ':'.join([self.prefix, 'pin', str(user.get('sub', ''))])
+
+    def _written_key(self, table):
+        return ':'.join([self.prefix, 'written', table])
+
+    @staticmethod
+    def _current_user():
+        return getattr(_request_ctx_stack.top, 'current_user', None)
+
+    def for_request(self):
+        """
+        Engine serving the queries of the current request: a replica for
+        reads of clients that are not pinned, None for the primary. The
+        choice is made once per request.
+        """
+        if not self.replicas or not has_request_context() or \
+                request.method not in READ_METHODS:
+            return None
+        if 'db_replica' not in g:
+            user = self._current_user()
+            if user is not None and \
+                    self.pins.get(self._pin_key(user)) is not None:
+                g.db_replica = None
+            else:
+                g.db_replica = self.choose()
+        return g.db_replica
+
+    def pin_after_write(self, response):
+        """
+        after_request hook pinning the client of a successful write to the
+        primary for pin_seconds, so it reads its own writes
+        """
+        if self.replicas and request.method not in READ_METHODS and \
+                response.status_code < 400:
+            user = self._current_user()
+            if user is not None:
+                self.pins.set(self._pin_key(user), 1, self.pin_seconds)
+        return response
+
+    def mark_written(self, table):
+        """
+        Records a committed write to table: for pin_seconds the replicas
+        may not have it yet
+        """
+        if self.replicas:
+            self.pins.set(self._written_key(table), 1, self.pin_seconds)
+
+    def settled(self, table):
+        """
+        False while the current request read table from a replica that
+        may lag behind a recent write, so its response must not be cached
+        """
+        if not self.replicas or not has_request_context() or \
+                g.get('db_replica') is None:
+            return True
+        return self.pins.get(self._written_key(table)) is None
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session sending the reads of read-only requests to a replica and
+    everything else, flushes included, to the primary
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if not self._flushing:
+            replica = self.db.replicas.for_request()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy with read replicas from the DATABASE_REPLICA_URLS setting
+    Example
+      `db = RoutingSQLAlchemy()`
+      `db.init_app(app)`
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.replicas = ReplicaSet()
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def init_app(self, app):
+        super().init_app(app)
+        self.replicas = ReplicaSet(
+            app.config.get('DATABASE_REPLICA_URLS', ()),
+            app.config.get('REPLICA_PIN_SECONDS', 10),
+            app.config.get('REPLICA_HEALTH_INTERVAL', 10),
+            pin_store(app.config.get('RESPONSE_CACHE_URL')),
+            connect_timeout=app.config.get('REPLICA_CONNECT_TIMEOUT', 2))
+        app.after_request(self.replicas.pin_after_write)
+        if response_cache is not None:
+            response_cache.replicas = self.replicas
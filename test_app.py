@@ -1,26 +1,121 @@
 import os
 import unittest
 import json
+import gzip
+import io
+import sqlite3
+import tempfile
+import threading
+import time
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import date, datetime, timezone
+from sqlalchemy import event
+from werkzeug.http import http_date
 
-from app import app
-from models import db, Actor, Movie
+# the tests run in a single process, where the in-process cache is
+# coherent; must be set before the app module reads its configuration
+os.environ.setdefault('RESPONSE_CACHE_URL', 'memory://')
+
+from app import app  # noqa: E402
+from models import db, fold_stats, Actor, Movie  # noqa: E402
+from auth import AuthError, JWKSKeyStore, TokenCache, \
+    check_permissions, normalize_permissions  # noqa: E402
+from cache import MemoryBackend, RedisBackend, ResponseCache  # noqa: E402
+from compression import compress_chunks, compress_response  # noqa: E402
+from config import database_url  # noqa: E402
+from pooling import InstrumentedQueuePool  # noqa: E402
+from responses import JSON_ENCODERS, orjson  # noqa: E402
+from routing import ReplicaSet  # noqa: E402
+from transfer import InvalidRow, export_rows, import_rows  # noqa: E402
+
+# 'wsgi' runs the scenarios against app.py, 'asgi' against asgi.py
+APP_MODE = os.environ.get('APP_MODE', 'wsgi')
+if APP_MODE == 'asgi':
+    import asyncio
+    import asgi
+    from flask import json as flask_json
+    from werkzeug.datastructures import Headers
 
 assistant_token = "Bearer {}".format(os.environ.get('ASSISTANT_JWT'))
 director_token = "Bearer {}".format(os.environ.get('DIRECTOR_JWT'))
 producer_token = "Bearer {}".format(os.environ.get('PRODUCER_JWT'))
 
 
+class ASGITestClient(object):
+    """
+    Runs requests through asgi.app on one event loop, with the methods of
+    the Flask test client the tests call and Flask responses
+    """
+    loop = None
+
+    def open(self, method, path, headers=None, json=None):
+        if ASGITestClient.loop is None:
+            ASGITestClient.loop = asyncio.new_event_loop()
+        path, _, query = path.partition('?')
+        # Headers drops the empty values the tests send, like the Flask
+        # test client
+        headers = Headers(headers or {})
+        headers['Host'] = 'localhost'
+        body = b''
+        if json is not None:
+            body = flask_json.dumps(json).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+            headers['Content-Length'] = str(len(body))
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'},
+            'http_version': '1.1', 'method': method, 'scheme': 'http',
+            'path': path, 'raw_path': path.encode('utf-8'),
+            'root_path': '', 'query_string': query.encode('utf-8'),
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers.to_wsgi_list()],
+            'client': ('127.0.0.1', 0), 'server': ('localhost', 80)
+        }
+        messages = [{'type': 'http.request', 'body': body}]
+        response = {'body': b''}
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+                response['headers'] = [
+                    (name.decode('latin-1'), value.decode('latin-1'))
+                    for name, value in message['headers']]
+            else:
+                response['body'] += message.get('body', b'')
+
+        ASGITestClient.loop.run_until_complete(asgi.app(scope, receive, send))
+        return app.response_class(response['body'], status=response['status'],
+                                  headers=response['headers'])
+
+    def get(self, path, **kwargs):
+        return self.open('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open('POST', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.open('PATCH', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open('DELETE', path, **kwargs)
+
+
 class CastingAgencyTestCase(unittest.TestCase):
     """This class represents the casting agency test case"""
 
     def setUp(self):
         self.app = app
         self.client = self.app.test_client
+        if APP_MODE == 'asgi':
+            self.client = ASGITestClient
         self.app = app
-        self.app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
-            'TEST_DATABASE_URL')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = database_url(
+            os.environ.get('TEST_DATABASE_URL'))
 
         self.new_actor = {
             "name": "actor3",
@@ -59,6 +154,281 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertTrue(data['success'])
         self.assertTrue(len(data['movies']) >= 0)
 
+    def test_get_actors_pages(self):
+        """Test actors GET endpoint keyset pagination"""
+        res = self.client().get(
+            '/actors?limit=1', headers={"Authorization": (assistant_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        if data['next_cursor']:
+            res_next = self.client().get(
+                '/actors?limit=1&cursor={}'.format(data['next_cursor']),
+                headers={"Authorization": (assistant_token)})
+            data_next = json.loads(res_next.data)
+            self.assertEqual(res_next.status_code, 200)
+            self.assertGreater(data_next['actors'][0]['id'],
+                               data['actors'][0]['id'])
+
+    def test_get_movies_by_ids(self):
+        """Test movies GET endpoint resolving a list of ids"""
+        res = self.client().get('/movies?ids=2,100000,1',
+                                headers={"Authorization": (director_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [2, 1])
+        self.assertEqual(data['missing'], [100000])
+
+    def test_get_movies_by_duplicate_ids(self):
+        """Test movies GET endpoint keeps the first of duplicate ids"""
+        res = self.client().get('/movies?ids=2,1,2,1',
+                                headers={"Authorization": (director_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [2, 1])
+
+    def test_too_many_ids_get_movies(self):
+        """Test movies GET endpoint refuses more than MAX_IDS ids"""
+        ids = ','.join(['1'] * (self.app.config['MAX_IDS'] + 1))
+        res = self.client().get(f'/movies?ids={ids}',
+                                headers={"Authorization": (director_token)})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_include_actors_query_count(self):
+        """Test movies GET endpoint loads casts in constant queries"""
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        counts = []
+        try:
+            for limit in (1, 100):
+                del statements[:]
+                res = self.client().get(
+                    '/movies?include=actors&limit={}'.format(limit),
+                    headers={"Authorization": (director_token)})
+                data = json.loads(res.data)
+                self.assertEqual(res.status_code, 200)
+                self.assertTrue(
+                    all('actors' in movie for movie in data['movies']))
+                counts.append(len(statements))
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_assign_actors(self):
+        """Test movie actors POST endpoint"""
+        res = self.client().post('/movies/1/actors', json={"actor_ids": [1]},
+                                 headers={"Authorization": (producer_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        res_movie = self.client().get(
+            '/movies/1?include=actors',
+            headers={"Authorization": (producer_token)})
+        actors = json.loads(res_movie.data)['movie']['actors']
+        self.assertIn(1, [actor['id'] for actor in actors])
+
+    def test_unassign_actors_missing_movie(self):
+        """Test movie actors DELETE endpoint with an unknown movie"""
+        res = self.client().delete('/movies/100000/actors',
+                                   json={"actor_ids": [1]},
+                                   headers={"Authorization": (producer_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actor_include_movies_after_movie_edit(self):
+        """Test actor GET endpoint with include sees an edit of a movie"""
+        res = self.client().post('/movies', json=self.new_movie,
+                                 headers={"Authorization": (producer_token)})
+        movie_id = json.loads(res.data)['movie']['id']
+        self.client().post(f'/movies/{movie_id}/actors',
+                           json={"actor_ids": [1]},
+                           headers={"Authorization": (producer_token)})
+        res = self.client().get('/actors/1?include=movies',
+                                headers={"Authorization": (producer_token)})
+        etag = res.headers['ETag']
+        self.client().patch(f'/movies/{movie_id}', json={"title": "movie4"},
+                            headers={"Authorization": (producer_token)})
+        res = self.client().get('/actors/1?include=movies',
+                                headers={"Authorization": (producer_token),
+                                         "If-None-Match": etag})
+        movies = json.loads(res.data)['actor']['movies']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.assertIn('movie4', [movie['title'] for movie in movies])
+
+    def test_get_actors_filtered(self):
+        """Test actors GET endpoint with search filters"""
+        res = self.client().get('/actors?name_prefix=ACTOR&age_min=20',
+                                headers={"Authorization": (assistant_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for actor in data['actors']:
+            self.assertTrue(actor['name'].lower().startswith('actor'))
+            self.assertGreaterEqual(actor['age'], 20)
+
+    def test_get_actors_count(self):
+        """Test actors GET endpoint with an exact total count"""
+        res = self.client().get('/actors?limit=1&count=exact',
+                                headers={"Authorization": (assistant_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_mode'], 'exact')
+        self.assertGreaterEqual(data['total'], len(data['actors']))
+
+    def test_get_actors_count_estimated(self):
+        """Test actors GET endpoint never reports a count it did not use"""
+        res = self.client().get('/actors?limit=1&count=estimated&age_min=20',
+                                headers={"Authorization": (assistant_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        if 'total' in data:
+            self.assertEqual(data['total_mode'], 'estimated')
+        else:
+            self.assertNotIn('total_mode', data)
+
+    def test_invalid_count_get_actors(self):
+        """Test actors GET endpoint with an unknown count mode"""
+        res = self.client().get('/actors?count=bogus',
+                                headers={"Authorization": (assistant_token)})
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_fields(self):
+        """Test actors GET endpoint with a sparse fieldset"""
+        res = self.client().get('/actors?fields=id,name',
+                                headers={"Authorization": (assistant_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for actor in data['actors']:
+            self.assertEqual(set(actor), {'id', 'name'})
+
+    def test_get_actors_not_modified(self):
+        """Test actors GET endpoint revalidation with an ETag"""
+        res = self.client().get(
+            '/actors', headers={"Authorization": (assistant_token)})
+        etag = res.headers['ETag']
+        res_cached = self.client().get(
+            '/actors', headers={"Authorization": (assistant_token),
+                                "If-None-Match": etag})
+
+        self.assertEqual(res_cached.status_code, 304)
+        self.assertEqual(res_cached.data, b'')
+        self.assertEqual(res_cached.headers['ETag'], etag)
+
+    def test_get_actors_modified_after_delete(self):
+        """Test actors GET endpoint ETag changes when a row is deleted"""
+        res = self.client().post('/actors', json=self.new_actor,
+                                 headers={"Authorization": (director_token)})
+        actor_id = json.loads(res.data)['actor']['id']
+        etag = self.client().get(
+            '/actors', headers={"Authorization": (assistant_token)}
+        ).headers['ETag']
+        self.client().delete(
+            f'/actors/{actor_id}', headers={"Authorization": (director_token)})
+        res = self.client().get(
+            '/actors', headers={"Authorization": (assistant_token),
+                                "If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_actors_modified_since_after_delete(self):
+        """Test actors GET endpoint If-Modified-Since after a delete"""
+        res = self.client().post('/actors', json=self.new_actor,
+                                 headers={"Authorization": (director_token)})
+        actor_id = json.loads(res.data)['actor']['id']
+        self.client().delete(
+            f'/actors/{actor_id}', headers={"Authorization": (director_token)})
+        res = self.client().get(
+            '/actors', headers={"Authorization": (assistant_token),
+                                "If-Modified-Since": http_date(time.time())})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn('Last-Modified', res.headers)
+
+    def test_get_movie(self):
+        """Test movie GET endpoint"""
+        res = self.client().get(
+            '/movies/1', headers={"Authorization": (director_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie']['id'], 1)
+        self.assertIn('ETag', res.headers)
+
+    def test_export_actors(self):
+        """Test actors streaming export endpoint"""
+        res = self.client().get(
+            '/actors/export', headers={"Authorization": (assistant_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertTrue(len(data['actors']) >= 0)
+
+    def test_export_movies_ndjson(self):
+        """Test movies streaming export endpoint with NDJSON lines"""
+        res = self.client().get('/movies/export?format=ndjson',
+                                headers={"Authorization": (director_token)})
+        movies = [json.loads(line) for line in res.data.splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(all('title' in movie for movie in movies))
+
+    def test_export_actors_gzip(self):
+        """Test actors streaming export endpoint compressed with gzip"""
+        res = self.client().get('/actors/export', headers={
+            "Authorization": (assistant_token), "Accept-Encoding": "gzip"})
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(data['success'])
+
+    def test_get_stats(self):
+        """Test stats GET endpoint counters agree with GROUP BY"""
+        headers = {"Authorization": (producer_token)}
+        res = self.client().get('/stats', headers=headers)
+        data = json.loads(res.data)
+        res_live = self.client().get('/stats?source=live', headers=headers)
+        data_live = json.loads(res_live.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['source'], 'summary')
+        for dimension in ('actors_by_gender', 'actors_by_age',
+                          'movies_by_release_year'):
+            self.assertEqual(data[dimension], data_live[dimension])
+
+    def test_get_metrics(self):
+        """Test metrics GET endpoint reports the pool occupancy"""
+        self.client().get(
+            '/actors', headers={"Authorization": (producer_token)})
+        res = self.client().get('/metrics',
+                                headers={"Authorization": (producer_token)})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(data['pool']['checkouts'], 0)
+        self.assertLessEqual(data['pool']['saturation'], 1)
+
     def test_add_new_actor(self):
         """Test actors POST endpoint"""
         res = self.client().post('/actors', json=self.new_actor,
@@ -68,6 +438,19 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['actor']['name'], 'actor3')
 
+    def test_add_new_actor_idempotent(self):
+        """Test actors POST endpoint replays a retry with the same key"""
+        headers = {"Authorization": (director_token),
+                   "Idempotency-Key": f"test-{time.time()}"}
+        res = self.client().post('/actors', json=self.new_actor,
+                                 headers=headers)
+        res_retry = self.client().post('/actors', json=self.new_actor,
+                                       headers=headers)
+        self.assertEqual(res_retry.status_code, 201)
+        self.assertEqual(res_retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(json.loads(res_retry.data)['actor']['id'],
+                         json.loads(res.data)['actor']['id'])
+
     def test_add_new_movie(self):
         """Test movie POST endpoint"""
         res = self.client().post('/movies', json=self.new_movie,
@@ -77,6 +460,28 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['movie']['title'], 'movie3')
 
+    def test_add_new_actors_bulk(self):
+        """Test actors bulk POST endpoint"""
+        res = self.client().post('/actors/bulk',
+                                 json=[self.new_actor, self.new_actor],
+                                 headers={"Authorization": (director_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['created']), 2)
+
+    def test_import_export_actors(self):
+        """Test actors are loaded and dumped with COPY"""
+        lines = io.StringIO('name,age,gender\nactor5,41,F\nactor6,42,M\n')
+        out = io.BytesIO()
+        with self.app.app_context():
+            loaded, skipped = import_rows(Actor, lines, 'csv')
+            export_rows(Actor, out, 'ndjson')
+        actors = [json.loads(line) for line in out.getvalue().splitlines()]
+
+        self.assertEqual((loaded, skipped), (2, 0))
+        self.assertIn('actor6', [actor['name'] for actor in actors])
+
     def test_edit_actor(self):
         """Test actors PATCH endpoint"""
         res = self.client().patch('/actors/1', json=self.new_actor,
@@ -86,6 +491,56 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['actor']['name'], 'actor3')
 
+    def test_partial_edit_actor(self):
+        """Test actors PATCH endpoint with a partial body"""
+        res = self.client().patch('/actors/2', json={"age": 40},
+                                  headers={"Authorization": (director_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['age'], 40)
+        self.assertTrue(data['actor']['name'])
+
+    def test_edit_actors_bulk(self):
+        """Test actors bulk PATCH endpoint by id list"""
+        res = self.client().post('/actors/bulk',
+                                 json=[self.new_actor, self.new_actor],
+                                 headers={"Authorization": (producer_token)})
+        ids = json.loads(res.data)['created']
+        res_edit = self.client().patch(
+            '/actors', json={"ids": ids, "values": {"age": 26}},
+            headers={"Authorization": (producer_token)})
+        data = json.loads(res_edit.data)
+        self.assertEqual(res_edit.status_code, 200)
+        self.assertEqual(data['updated'], 2)
+
+    def test_edit_actors_bulk_over_max_rows(self):
+        """Test actors bulk PATCH endpoint refuses before updating rows"""
+        res = self.client().post('/actors/bulk',
+                                 json=[self.new_actor, self.new_actor],
+                                 headers={"Authorization": (producer_token)})
+        ids = json.loads(res.data)['created']
+        statements = []
+
+        def record_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', record_statement)
+        max_rows = self.app.config['BULK_MAX_ROWS']
+        self.app.config['BULK_MAX_ROWS'] = 1
+        try:
+            res_edit = self.client().patch(
+                '/actors', json={"ids": ids, "values": {"age": 26}},
+                headers={"Authorization": (producer_token)})
+        finally:
+            self.app.config['BULK_MAX_ROWS'] = max_rows
+            event.remove(engine, 'before_cursor_execute', record_statement)
+
+        self.assertEqual(res_edit.status_code, 422)
+        self.assertFalse(any(statement.lstrip().upper().startswith('UPDATE')
+                             for statement in statements))
+
     def test_edit_movie(self):
         """Test movie PATCH endpoint"""
         res = self.client().patch('/movies/1', json=self.new_movie,
@@ -148,6 +603,15 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 403)
         self.assertFalse(data['success'], True)
 
+    def test_reused_key_add_new_actor(self):
+        """Test actors POST endpoint rejects a key reused for another body"""
+        headers = {"Authorization": (director_token),
+                   "Idempotency-Key": f"test-{time.time()}"}
+        self.client().post('/actors', json=self.new_actor, headers=headers)
+        res = self.client().post('/actors', json={
+            'name': 'actor4', 'age': 40, 'gender': 'M'}, headers=headers)
+        self.assertEqual(res.status_code, 422)
+
     def test_no_data_add_new_movie(self):
         """Test movie POST endpoint without data"""
         res = self.client().post('/movies', json={},
@@ -156,6 +620,91 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertFalse(data['success'], True)
 
+    def test_invalid_cursor_get_movies(self):
+        """Test movies GET endpoint with a malformed cursor"""
+        res = self.client().get('/movies?cursor=invalid',
+                                headers={"Authorization": (director_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_unknown_fields_get_movies(self):
+        """Test movies GET endpoint with a field that does not exist"""
+        res = self.client().get('/movies?fields=title,budget',
+                                headers={"Authorization": (director_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_no_data_get_actor(self):
+        """Test actor GET endpoint for an actor that does not exist"""
+        res = self.client().get(
+            '/actors/100000', headers={"Authorization": (assistant_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    def test_invalid_item_add_new_movies_bulk(self):
+        """Test movies bulk POST endpoint reports invalid items"""
+        res = self.client().post('/movies/bulk', json=[
+            {"title": "movie4", "release_date": "2020-06-01"},
+            {"title": "movie5"}
+        ], headers={"Authorization": (producer_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['errors'][0]['index'], 1)
+
+    def test_unknown_filter_get_movies(self):
+        """Test movies GET endpoint with a filter that does not exist"""
+        res = self.client().get('/movies?budget_min=100',
+                                headers={"Authorization": (director_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
+    def test_get_stats_after_writes(self):
+        """Test stats counters follow writes, before and after folding"""
+        headers = {"Authorization": (producer_token)}
+        res_post = self.client().post('/actors', json=self.new_actor,
+                                      headers=headers)
+        data = json.loads(self.client().get('/stats', headers=headers).data)
+        with self.app.app_context():
+            fold_stats()
+        data_folded = json.loads(
+            self.client().get('/stats', headers=headers).data)
+        data_live = json.loads(
+            self.client().get('/stats?source=live', headers=headers).data)
+
+        self.assertEqual(res_post.status_code, 201)
+        for dimension in ('actors_by_gender', 'actors_by_age'):
+            self.assertEqual(data[dimension], data_live[dimension])
+            self.assertEqual(data_folded[dimension], data_live[dimension])
+
+    def test_unauthorized_get_stats(self):
+        """Test stats GET endpoint requires both read permissions"""
+        res = self.client().get(
+            '/stats', headers={"Authorization": (assistant_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 403)
+        self.assertFalse(data['success'])
+
+    def test_invalid_row_import_actors(self):
+        """Test an invalid row aborts the whole import"""
+        lines = io.StringIO('name,age,gender\nactor7,41,F\nactor8,old,M\n')
+        with self.app.app_context():
+            with self.assertRaises(InvalidRow) as context:
+                import_rows(Actor, lines, 'csv')
+            self.assertEqual(Actor.query.filter_by(name='actor7').count(), 0)
+        self.assertEqual(context.exception.line, 3)
+
+    def test_unauthorized_get_metrics(self):
+        """Test metrics GET endpoint needs the get:metrics permission"""
+        res = self.client().get('/metrics',
+                                headers={"Authorization": (assistant_token)})
+
+        self.assertEqual(res.status_code, 403)
+
     def test_unauthorized_edit_actor(self):
         """Test actors PATCH endpoint with unauthorized assistant role"""
         res = self.client().patch('/actors/1', json=self.new_actor,
@@ -172,6 +721,22 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertFalse(data['success'], True)
 
+    def test_no_data_edit_actor(self):
+        """Test actors PATCH endpoint for an actor that does not exist"""
+        res = self.client().patch('/actors/100000', json={"age": 40},
+                                  headers={"Authorization": (director_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 404)
+        self.assertFalse(data['success'])
+
+    def test_no_filter_delete_movies_bulk(self):
+        """Test movies bulk DELETE endpoint without ids or filter"""
+        res = self.client().delete('/movies', json={"filter": {}},
+                                   headers={"Authorization": (producer_token)})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+
     def test_unauthorized_delete_actor(self):
         """Test actor DELETE endpoint with unauthorized assistant role"""
         res = self.client().post('/actors', json=self.new_actor,
@@ -194,6 +759,414 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'], True)
 
 
+class DatabaseUrlTestCase(unittest.TestCase):
+    """Tests the database urls handed to SQLAlchemy"""
+
+    def test_heroku_postgres_scheme(self):
+        """Test postgres:// urls are renamed to postgresql://"""
+        self.assertEqual(database_url('postgres://u:p@host:5432/casting'),
+                         'postgresql://u:p@host:5432/casting')
+
+    def test_other_urls_unchanged(self):
+        """Test other urls and an unset url are kept as they are"""
+        for url in ('postgresql://host/casting', 'sqlite:///casting.db',
+                    None):
+            self.assertEqual(database_url(url), url)
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+    """This class represents the JWKS key store test case"""
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile(
+            'w', suffix='.json', delete=False)
+        self.write_keys('key1')
+        self.store = JWKSKeyStore(
+            'file://' + self.jwks_file.name, ttl=3600,
+            min_refresh_interval=3600)
+
+    def tearDown(self):
+        """Executed after reach test"""
+        os.unlink(self.jwks_file.name)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_file.name, 'w') as jwks_file:
+            json.dump({'keys': [{
+                'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n', 'e': 'AQAB'
+            } for kid in kids]}, jwks_file)
+
+    def test_keys_are_cached(self):
+        """Test the key set is fetched once for repeated lookups"""
+        for _ in range(3):
+            self.assertEqual(self.store.get_key('key1')['kid'], 'key1')
+        stats = self.store.stats()
+        self.assertEqual(stats['refreshes'], 1)
+        self.assertEqual(stats['hits'], 3)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        """Test unknown kids cannot trigger a refresh storm"""
+        self.store.get_key('key1')
+        self.write_keys('key1', 'key2')
+        self.assertIsNone(self.store.get_key('forged'))
+        self.assertIsNone(self.store.get_key('key2'))
+        stats = self.store.stats()
+        self.assertEqual(stats['refreshes'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_unknown_kid_picks_up_rotated_keys(self):
+        """Test an unknown kid refreshes the key set after key rotation"""
+        store = JWKSKeyStore(
+            'file://' + self.jwks_file.name, min_refresh_interval=0)
+        store.get_key('key1')
+        self.write_keys('key2')
+        self.assertEqual(store.get_key('key2')['kid'], 'key2')
+        self.assertIsNone(store.get_key('key1'))
+        self.assertEqual(store.stats()['refreshes'], 3)
+
+    def test_rotation_clears_token_cache(self):
+        """Test cached tokens are dropped when the signing keys rotate"""
+        store = JWKSKeyStore(
+            'file://' + self.jwks_file.name, min_refresh_interval=0)
+        cache = TokenCache()
+        store.add_rotation_listener(cache.clear)
+        store.get_key('key1')
+        cache.set('token', {'sub': 'user'})
+        self.write_keys('key2')
+        store.get_key('key2')
+        self.assertIsNone(cache.get('token'))
+
+    def test_failed_refresh_keeps_stale_keys(self):
+        """Test an expired key set is fetched once while Auth0 is down"""
+        store = JWKSKeyStore(
+            'file://' + self.jwks_file.name, ttl=60, min_refresh_interval=30)
+        store.get_key('key1')
+        store._fetched_at -= 61
+        fetches = []
+
+        def failing_fetch():
+            fetches.append(1)
+            time.sleep(0.05)
+            raise OSError('unreachable')
+
+        store.fetch = failing_fetch
+        keys = []
+        threads = [
+            threading.Thread(target=lambda: keys.append(store.get_key('key1')))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        keys.append(store.get_key('key1'))
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual([key['kid'] for key in keys], ['key1'] * 6)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def test_cached_payload(self):
+        """Test a verified token is served from the cache"""
+        cache = TokenCache()
+        cache.set('token', {'sub': 'user', 'exp': time.time() + 60})
+        self.assertEqual(cache.get('token')['sub'], 'user')
+        self.assertIsNone(cache.get('other'))
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_expired_token_is_not_served(self):
+        """Test a cached token expires with its exp claim"""
+        cache = TokenCache()
+        cache.set('token', {'sub': 'user', 'exp': time.time() - 1})
+        self.assertIsNone(cache.get('token'))
+
+    def test_least_recently_used_token_is_evicted(self):
+        """Test the cache is bounded by max_size"""
+        cache = TokenCache(max_size=2)
+        cache.set('token1', {'sub': 'user1'})
+        cache.set('token2', {'sub': 'user2'})
+        cache.get('token1')
+        cache.set('token3', {'sub': 'user3'})
+        self.assertIsNone(cache.get('token2'))
+        self.assertIsNotNone(cache.get('token1'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """This class represents the permission check test case"""
+
+    def setUp(self):
+        self.payload = {'permissions': ['get:actor', 'post:Movies']}
+
+    def test_permissions_are_normalized(self):
+        """Test mixed-case scopes match regardless of case"""
+        self.assertTrue(check_permissions('POST:movies', self.payload))
+        self.assertEqual(self.payload['permission_set'],
+                         frozenset(['get:actor', 'post:movies']))
+
+    def test_all_of_permissions(self):
+        """Test every permission of an all-of set is required"""
+        self.assertTrue(check_permissions(
+            normalize_permissions(['get:actor', 'post:movies']),
+            self.payload))
+        with self.assertRaises(AuthError) as context:
+            check_permissions(
+                normalize_permissions(['get:actor', 'get:movies']),
+                self.payload)
+        self.assertEqual(context.exception.status_code, 403)
+
+    def test_any_of_permissions(self):
+        """Test one permission of an any-of set is enough"""
+        self.assertTrue(check_permissions(
+            frozenset(), self.payload,
+            normalize_permissions(['get:movies', 'get:actor'])))
+        with self.assertRaises(AuthError):
+            check_permissions(
+                frozenset(), self.payload,
+                normalize_permissions(['get:movies', 'delete:movies']))
+
+    def test_missing_permissions_claim(self):
+        """Test a token without permissions claim is rejected"""
+        with self.assertRaises(AuthError) as context:
+            check_permissions('get:actor', {})
+        self.assertEqual(context.exception.status_code, 400)
+
+
+class RedisStandIn(object):
+    """Local stand-in for a redis client, storing values as bytes"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.values:
+            return None
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        self.values[key] = value
+        return True
+
+    def incr(self, key):
+        value = int(self.values.get(key, 0)) + 1
+        self.values[key] = str(value).encode('utf-8')
+        return value
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache test case"""
+
+    def setUp(self):
+        self.caches = [
+            ResponseCache(MemoryBackend()),
+            ResponseCache(RedisBackend(RedisStandIn()))
+        ]
+
+    def test_key_depends_on_request(self):
+        """Test query parameters and permissions are part of the key"""
+        for cache in self.caches:
+            with app.test_request_context('/actors?limit=1'):
+                key = cache.key('actors', permissions={'get:actor'})
+                self.assertEqual(
+                    key, cache.key('actors', permissions={'get:actor'}))
+                self.assertNotEqual(key, cache.key('actors'))
+            with app.test_request_context('/actors?limit=2'):
+                self.assertNotEqual(
+                    key, cache.key('actors', permissions={'get:actor'}))
+
+    def test_write_invalidates_affected_keys(self):
+        """Test a write invalidates the lists and its own row only"""
+        for cache in self.caches:
+            with app.test_request_context('/actors/1'):
+                list_key = cache.key('actors')
+                row_key = cache.key('actors', 1)
+                other_row_key = cache.key('actors', 2)
+                cache.invalidate('actors', 1)
+                self.assertNotEqual(list_key, cache.key('actors'))
+                self.assertNotEqual(row_key, cache.key('actors', 1))
+                self.assertEqual(other_row_key, cache.key('actors', 2))
+
+    def test_cached_view(self):
+        """Test a cached view only runs once per generation"""
+        for cache in self.caches:
+            calls = []
+
+            @cache.cached('actors')
+            def view(payload):
+                calls.append(payload)
+                return app.response_class(b'[]', mimetype='application/json')
+
+            with app.test_request_context('/actors'):
+                self.assertEqual(view({}).get_data(), b'[]')
+                self.assertEqual(view({}).get_data(), b'[]')
+                cache.invalidate('actors')
+                view({})
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2})
+
+
+class JSONEncodersTestCase(unittest.TestCase):
+    """This class represents the JSON encoding backends test case"""
+
+    def setUp(self):
+        self.obj = {
+            'success': True,
+            'actors': [{
+                'id': 1, 'name': 'Zoë', 'age': 25, 'rating': 4.5,
+                'birthday': date(1995, 5, 27), 'bio': None,
+                'updated_at': datetime(2020, 5, 27, 21, 36, 9, 120000)
+            }],
+            'created_at': datetime(2020, 5, 27, 21, 36, 9,
+                                   tzinfo=timezone.utc)
+        }
+
+    def test_stdlib_encoding(self):
+        """Test the json backend output is compact with ISO-8601 dates"""
+        self.assertEqual(
+            JSON_ENCODERS['json'](self.obj),
+            '{"success":true,"actors":[{"id":1,"name":"Zoë","age":25,'
+            '"rating":4.5,"birthday":"1995-05-27","bio":null,'
+            '"updated_at":"2020-05-27T21:36:09.120000"}],'
+            '"created_at":"2020-05-27T21:36:09+00:00"}'.encode('utf-8'))
+
+    @unittest.skipIf(orjson is None, 'orjson is not installed')
+    def test_backends_agree(self):
+        """Test the orjson backend output matches the json backend"""
+        self.assertEqual(JSON_ENCODERS['orjson'](self.obj),
+                         JSON_ENCODERS['json'](self.obj))
+
+
+class CompressionTestCase(unittest.TestCase):
+    """This class represents the response compression test case"""
+
+    def test_threshold(self):
+        """Test only bodies above COMPRESS_MIN_SIZE are compressed"""
+        small = b'{"success":true}'
+        large = b'[' + b'{"name":"actor"},' * 200 + b'{}]'
+        with app.test_request_context(
+                '/actors', headers={'Accept-Encoding': 'gzip'}):
+            response = compress_response(app.response_class(
+                small, mimetype='application/json'))
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.get_data(), small)
+            response = compress_response(app.response_class(
+                large, mimetype='application/json'))
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(gzip.decompress(response.get_data()), large)
+            self.assertIn('Accept-Encoding', response.vary)
+
+    def test_identity(self):
+        """Test responses stay uncompressed without Accept-Encoding"""
+        body = b'[' + b'{"name":"actor"},' * 200 + b'{}]'
+        with app.test_request_context('/actors'):
+            response = compress_response(app.response_class(
+                body, mimetype='application/json'))
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.get_data(), body)
+
+    def test_chunks(self):
+        """Test streamed chunks decompress to the original stream"""
+        chunks = [b'{"id":%d}\n' % i for i in range(100)]
+        compressed = list(compress_chunks(iter(chunks), 'gzip'))
+        self.assertEqual(gzip.decompress(b''.join(compressed)),
+                         b''.join(chunks))
+
+
+class InstrumentedQueuePoolTestCase(unittest.TestCase):
+    """This class represents the instrumented connection pool test case"""
+
+    def setUp(self):
+        self.pool = InstrumentedQueuePool(
+            lambda: sqlite3.connect(':memory:'),
+            pool_size=1, max_overflow=0, timeout=0.1)
+
+    def test_checkouts_are_counted(self):
+        """Test checkouts and occupancy are reported"""
+        connection = self.pool.connect()
+        stats = self.pool.stats()
+        connection.close()
+
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['checked_out'], 1)
+        self.assertEqual(stats['saturation'], 1)
+
+    def test_timeouts_are_counted(self):
+        """Test a checkout of an exhausted pool waits then times out"""
+        connection = self.pool.connect()
+        with self.assertRaises(Exception):
+            self.pool.connect()
+        connection.close()
+
+        self.assertEqual(self.pool.stats()['timeouts'], 1)
+        self.assertGreaterEqual(self.pool.stats()['wait_seconds_max'], 0.1)
+
+
+class ReplicaSetTestCase(unittest.TestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.urls = [
+            f'sqlite:///{self.directory.name}/replica1.db',
+            f'sqlite:///{self.directory.name}/missing/replica2.db',
+            f'sqlite:///{self.directory.name}/replica3.db'
+        ]
+        self.replicas = ReplicaSet(self.urls, pin_seconds=60)
+        self.replicas.check_all()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_unchecked_replicas_are_not_chosen(self):
+        """Test reads stay on the primary until a replica passed a check"""
+        replicas = ReplicaSet(self.urls[:1], health_interval=3600)
+        replicas._checker_pid = os.getpid()
+
+        self.assertIsNone(replicas.choose())
+
+    def test_round_robin_skips_unhealthy_replicas(self):
+        """Test replicas are chosen in turn, without the failing one"""
+        chosen = [str(self.replicas.choose().url) for _ in range(4)]
+
+        self.assertEqual(chosen, [self.urls[0], self.urls[2]] * 2)
+
+    def test_reads_go_to_replicas(self):
+        """Test reads use a replica and writes the primary"""
+        with app.test_request_context('/actors'):
+            self.assertIsNotNone(self.replicas.for_request())
+        with app.test_request_context('/actors', method='POST'):
+            self.assertIsNone(self.replicas.for_request())
+
+    def test_write_pins_client_to_primary(self):
+        """Test a client reads from the primary after its own write"""
+        with app.test_request_context('/actors', method='POST') as context:
+            context.current_user = {'sub': 'writer'}
+            self.replicas.pin_after_write(app.response_class(status=201))
+        with app.test_request_context('/actors') as context:
+            context.current_user = {'sub': 'writer'}
+            self.assertIsNone(self.replicas.for_request())
+        with app.test_request_context('/actors') as context:
+            context.current_user = {'sub': 'reader'}
+            self.assertIsNotNone(self.replicas.for_request())
+
+    def test_replica_reads_not_cached_after_write(self):
+        """Test a page read from a replica is not cached after a write"""
+        with app.test_request_context('/actors'):
+            self.replicas.for_request()
+            self.assertTrue(self.replicas.settled('actors'))
+            self.replicas.mark_written('actors')
+            self.assertFalse(self.replicas.settled('actors'))
+            self.assertTrue(self.replicas.settled('movies'))
+        with app.test_request_context('/actors') as context:
+            context.current_user = {'sub': 'writer'}
+            self.replicas.pins.set(self.replicas._pin_key({'sub': 'writer'}),
+                                   1)
+            self.assertIsNone(self.replicas.for_request())
+            self.assertTrue(self.replicas.settled('actors'))
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,210 @@
+import csv
+import io
+import json
+import sys
+import time
+from datetime import datetime
+from models import db
+from cache import invalidate
+
+FORMATS = ('csv', 'ndjson')
+
+# rows sent per COPY FROM STDIN statement by import_rows
+COPY_CHUNK_SIZE = 10000
+
+
+class InvalidRow(Exception):
+    """Raised by import_rows for a row that fails validation"""
+
+    def __init__(self, line, message):
+        super().__init__(f'line {line}: {message}')
+        self.line = line
+
+
+# Progress reporting
+class Progress(object):
+    """
+    Prints the number of rows done and the throughput on one line of
+    stream, at most every interval seconds
+    """
+
+    def __init__(self, label, stream=sys.stderr, interval=0.5):
+        self.label = label
+        self.stream = stream
+        self.interval = interval
+        self.rows = 0
+        self.started = time.monotonic()
+        self._printed = 0.0
+
+    def add(self, rows):
+        self.rows += rows
+        now = time.monotonic()
+        if now - self._printed >= self.interval:
+            self._printed = now
+            self._print('\r')
+
+    def done(self):
+        self._print('\r')
+        self.stream.write('\n')
+        self.stream.flush()
+
+    def _print(self, prefix):
+        elapsed = time.monotonic() - self.started
+        rate = self.rows / elapsed if elapsed > 0 else 0
+        self.stream.write(f'{prefix}{self.label}: {self.rows:,} rows '
+                          f'in {elapsed:.1f}s ({rate:,.0f} rows/s)')
+        self.stream.flush()
+
+
+def format_of(path, fmt=None):
+    """returns fmt, or the format named by the extension of path"""
+    if fmt is None:
+        fmt = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+    if fmt not in FORMATS:
+        raise ValueError(f'unknown format {fmt}')
+    return fmt
+
+
+def _raw_connection():
+    connection = db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        raise RuntimeError('COPY needs a PostgreSQL database')
+    return connection.connection
+
+
+# Import
+def read_records(lines, fmt):
+    """
+    Parses CSV (with a header row) or NDJSON lines
+    :return iterator of (line number, dict)
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise InvalidRow(number, 'invalid JSON')
+        yield number, record
+
+
+def copy_chunks(model, records, columns, chunk_size=COPY_CHUNK_SIZE,
+                skip_invalid=False):
+    """
+    Validates and coerces records with model.validate and writes them
+    as CSV for COPY FROM STDIN, chunk_size rows at a time
+    :return iterator of (buffer, row count, skipped count) per chunk
+    :raises InvalidRow unless skip_invalid
+    """
+    now = datetime.utcnow()
+    buffer, writer = None, None
+    count = skipped = 0
+    for line, record in records:
+        try:
+            values = model.validate(record)
+        except ValueError as error:
+            if not skip_invalid:
+                raise InvalidRow(line, str(error))
+            skipped += 1
+            continue
+        values.setdefault('updated_at', now)
+        if buffer is None:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+        writer.writerow([values[column] for column in columns])
+        count += 1
+        if count == chunk_size:
+            buffer.seek(0)
+            yield buffer, count, skipped
+            buffer, count, skipped = None, 0, 0
+    if count or skipped:
+        if buffer is not None:
+            buffer.seek(0)
+        yield buffer, count, skipped
+
+
+def import_rows(model, lines, fmt, chunk_size=COPY_CHUNK_SIZE,
+                skip_invalid=False, progress=None):
+    """
+    Loads rows into the table of model with COPY FROM STDIN, one
+    statement per chunk of rows, all in one transaction, without
+    building ORM objects
+    Example
+      `import_rows(Actor, open('actors.csv'), 'csv')`
+    :return (rows loaded, rows skipped)
+    :raises InvalidRow for an invalid row unless skip_invalid, nothing
+      is loaded then
+    """
+    table = model.__table__
+    columns = [field for field in model.field_coercers] + ['updated_at']
+    statement = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        table.name, ', '.join(columns))
+    loaded = skipped = 0
+    try:
+        cursor = _raw_connection().cursor()
+        for buffer, count, chunk_skipped in copy_chunks(
+                model, read_records(lines, fmt), columns, chunk_size,
+                skip_invalid):
+            if count:
+                cursor.copy_expert(statement, buffer)
+            loaded += count
+            skipped += chunk_skipped
+            if progress is not None:
+                progress.add(count)
+        cursor.close()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    invalidate(table.name)
+    return loaded, skipped
+
+
+# Export
+class _CountingWriter(object):
+    """file object counting the lines written through it by COPY"""
+
+    def __init__(self, out, progress):
+        self.out = out
+        self.progress = progress
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.out.write(data)
+        if self.progress is not None:
+            self.progress.add(data.count(b'\n'))
+
+
+def export_statement(model, fmt):
+    """returns the COPY TO STDOUT statement of model in fmt"""
+    table = model.__table__
+    select = 'SELECT {} FROM {} ORDER BY id'.format(
+        ', '.join(model.format_fields), table.name)
+    if fmt == 'csv':
+        return f'COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)'
+    # csv format with quote and delimiter characters that JSON always
+    # escapes, so each document comes out verbatim on its own line
+    return (f'COPY (SELECT row_to_json(t) FROM ({select}) t) '
+            "TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')")
+
+
+def export_rows(model, out, fmt, progress=None):
+    """
+    Writes the rows of model, ordered by id, to the binary file out with
+    COPY TO STDOUT, streamed by the server without building ORM objects
+    Example
+      `export_rows(Movie, open('movies.ndjson', 'wb'), 'ndjson')`
+    """
+    cursor = _raw_connection().cursor()
+    try:
+        cursor.copy_expert(export_statement(model, fmt),
+                           _CountingWriter(out, progress))
+    finally:
+        cursor.close()
+        db.session.rollback()